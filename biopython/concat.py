@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 import sys
 import re
-import copy
-import os
+import tempfile
+import itertools
+import multiprocessing
+from bisect import bisect_right
 from argparse import ArgumentParser
 
 from Bio import AlignIO
-from Bio import Seq
 from Bio.Alphabet import IUPAC
-from Bio.Align import MultipleSeqAlignment
-from Bio.Nexus import Nexus
+from dzutils import nexus_safe_name
 
 def extract_name_with_regex(pattern, name):
     match = re.search(pattern, name)
@@ -19,6 +19,110 @@ def extract_name_with_regex(pattern, name):
     return ''.join([g for g in match.groups() if g])
 
 
+def read_alignment_rows(job):
+    '''Read one nexus alignment, possibly in a worker process.  Takes a single tuple of 
+    (filename, minimum taxa, maximum taxa) so it can be used with Pool.imap, and returns
+    (number of sequences, alignment length, list of (sequence name, sequence string)), with the
+    list being None if the number of sequences is outside of the range.  Only plain strings 
+    are returned, so that there is little to pickle back from workers.'''
+    filename, minTax, maxTax = job
+    with open(filename, "rb") as afile:
+        try:
+            thisAlign = AlignIO.read(afile, "nexus", alphabet=IUPAC.ambiguous_dna)
+        except ValueError:
+            sys.stderr.write('problem reading alignment %s' % filename)
+            raise
+    if not minTax <= len(thisAlign) <= maxTax:
+        return len(thisAlign), thisAlign.get_alignment_length(), None
+    return len(thisAlign), thisAlign.get_alignment_length(), [ (seq.name, str(seq.seq)) for seq in thisAlign ]
+
+
+class AlignmentSpool(object):
+    '''Holds the rows of a series of alignments in an anonymous temporary file rather than in memory,
+    along with the offset of each row in the file and the length of each alignment, so that
+    concatenated rows can be written out one at a time.  Only the offsets (one per taxon per 
+    alignment) are kept in memory.  The column at which each alignment starts in the concatenation
+    is kept too, so that pieces of rows (e.g. interleave blocks) start at the right alignment 
+    without going through all of those before it.
+    '''
+    def __init__(self):
+        self.spool = tempfile.TemporaryFile()
+        self.lengths = []
+        self.starts = []
+        self.offsets = []
+        self.names = set()
+        self._total_length = 0
+
+    def add_alignment(self, length, rows):
+        '''add an alignment of the given length, rows being (name, sequence string) tuples'''
+        offsets = {}
+        #reads and writes to the same file have to be separated by a seek
+        self.spool.seek(0, 2)
+        for name, seq in rows:
+            offsets[name] = self.spool.tell()
+            self.spool.write(seq)
+        self.lengths.append(length)
+        self.starts.append(self._total_length)
+        self._total_length += length
+        self.offsets.append(offsets)
+        self.names.update(offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def total_length(self):
+        return self._total_length
+
+    def write_row(self, out, name, start=0, end=None, missing='N'):
+        '''write columns start up to (not including) end of the concatenated row for name, filling 
+        alignments that it isn't in with missing'''
+        if end is None:
+            end = self.total_length()
+        if start >= end:
+            return
+        fill = missing * 4096
+        #the last alignment starting at or before start is the first that can overlap
+        for num in xrange(max(bisect_right(self.starts, start) - 1, 0), len(self.lengths)):
+            alignStart, length, offsets = self.starts[num], self.lengths[num], self.offsets[num]
+            alignEnd = alignStart + length
+            if alignEnd > start and alignStart < end:
+                first = max(start, alignStart) - alignStart
+                last = min(end, alignEnd) - alignStart
+                offset = offsets.get(name)
+                if offset is None:
+                    for written in xrange(first, last, len(fill)):
+                        out.write(fill[:last - written])
+                else:
+                    self.spool.seek(offset + first)
+                    out.write(self.spool.read(last - first))
+            elif alignStart >= end:
+                break
+
+
+def write_nexus_matrix(out, spool, names, interleave=None):
+    '''write a nexus data block of the concatenated rows for names, as Bio.Nexus would, but without 
+    ever holding more than one row.  If interleave is passed the matrix is interleaved in blocks
+    of that many columns'''
+    safeNames = [ nexus_safe_name(name) for name in names ]
+    nameWidth = max(len(name) for name in safeNames) + 1
+    nchar = spool.total_length()
+    out.write('#NEXUS\n')
+    out.write('begin data;\n')
+    out.write('\tdimensions ntax=%d nchar=%d;\n' % (len(names), nchar))
+    out.write('\tformat datatype=dna missing=? gap=-%s;\n' % (' interleave' if interleave else ''))
+    out.write('matrix\n')
+    blockWidth = interleave if interleave else nchar
+    #names are still written if there are no characters at all
+    for start in xrange(0, nchar, blockWidth) if nchar else [0]:
+        for name, safeName in zip(names, safeNames):
+            out.write(safeName.ljust(nameWidth))
+            spool.write_row(out, name, start, start + blockWidth)
+            out.write('\n')
+        if interleave:
+            out.write('\n')
+    out.write(';\nend;\n')
+
+
 #use argparse module to parse commandline input
 parser = ArgumentParser(description='concatenate a number of alignments, matching up taxon names across them')
 
@@ -27,6 +131,9 @@ parser = ArgumentParser(description='concatenate a number of alignments, matchin
 parser.add_argument('-i', '--interleave', action='store_true', default=False,
                     help='interleave the nexus output matrix')
 
+parser.add_argument('--block-width', type=int, default=70,
+                    help='number of columns in each block of an interleaved matrix (default 70)')
+
 parser.add_argument('-q', '--quiet', action='store_true', default=False,
                     help='output less crap to stderr')
 
@@ -46,6 +153,9 @@ parser.add_argument('--name-pattern', type=str, default='(.*)',
 parser.add_argument('-r', '--taxa-range', nargs=2, default=[1, 9999999999], 
                     help='only consider alignments with between the specified range of taxa')
 
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of processes to read alignments with (default 1).  Output is identical to that with one')
+
 #variable number of arguments
 parser.add_argument('filenames', nargs='*', default=[], 
                     help='a list of filenames to search')
@@ -76,24 +186,28 @@ if options.num_taxa:
 else:
     (minTax, maxTax) = options.taxa_range
 
-alignDicts = []
+#alignments are read one at a time, and only their rows are kept, in a temporary file
+spool = AlignmentSpool()
 
 charsetString = "begin sets;\n"
 charpartString = "charpartition concat = "
 num, startbase, endbase = 1, 1, 1
 
-for filename in options.filenames:
-    with open(filename, "rb") as afile:
-        try:
-            thisAlign = AlignIO.read(afile, "nexus", alphabet=IUPAC.ambiguous_dna)
-        except ValueError:
-            sys.stderr.write('problem reading alignment %s' % filename)
-            raise
-    
+jobs = [ (filename, minTax, maxTax) for filename in options.filenames ]
+pool = None
+if options.jobs > 1:
+    pool = multiprocessing.Pool(min(options.jobs, len(jobs)))
+    #imap hands back results in the order that the files were passed, so charset numbering is
+    #the same as when reading serially
+    results = pool.imap(read_alignment_rows, jobs, chunksize=4)
+else:
+    results = itertools.imap(read_alignment_rows, jobs)
+
+for filename, (numSeqs, alignLength, rows) in itertools.izip(options.filenames, results):
     thisDict = {}
-    if minTax <= len(thisAlign) <= maxTax:
-        for seq in thisAlign:
-            name =  extract_name_with_regex(options.name_pattern, seq.name)
+    if rows is not None:
+        for seqName, seq in rows:
+            name =  extract_name_with_regex(options.name_pattern, seqName)
             if name in thisDict:
                 sys.stderr.write("sequence name %s already found in alignment:\n" % name)
                 sys.stderr.write("filename %s\n" % filename)
@@ -102,18 +216,13 @@ for filename in options.filenames:
                     break
                 else:
                     sys.exit(1)
-            try:
-                thisDict[name] = seq
-            except KeyError:
-                sys.stderr.write("problem adding sequence %s to alignment dictionary\n" % name)
-                sys.stderr.write("filename %s\n" % filename)
-                sys.exit(1)
+            thisDict[name] = seq
         if thisDict:
             if not options.quiet:
                 sys.stderr.write("%d sequences in alignment\n" % len(thisDict))
-            alignDicts.append((thisDict, thisAlign))
+            spool.add_alignment(alignLength, thisDict.iteritems())
             
-            endbase = startbase + thisAlign.get_alignment_length() - 1
+            endbase = startbase + alignLength - 1
             thisCharsetString = "charset c%d = %d - %d; [%s]\n" % (num, startbase, endbase, re.sub('.*/', '', options.filenames[num-1]))
             thisCharpartString = "%d:c%d, " % (num, num)
             charsetString += thisCharsetString
@@ -121,52 +230,21 @@ for filename in options.filenames:
             startbase = endbase + 1
             num += 1
 
-sys.stderr.write("%d alignments read\n" % len(alignDicts))
+if pool is not None:
+    pool.close()
+    pool.join()
+
+sys.stderr.write("%d alignments read\n" % len(spool))
 
 #figure out all necessary taxa in the final alignment
-allNames = set()
-for mydict, alignment in alignDicts:
-    allNames |= set(mydict.iterkeys())
+allNames = sorted(spool.names)
 
 sys.stderr.write("%d names across all alignments\n" % len(allNames))
 
-#collect the sequences for each taxon for each alignment, or a dummy string of N's if they are missing from an alignment
-rawStrings = {}
-
-#loop over alignments
-for mydict, alignment in alignDicts:
-    dummy = 'N' * alignment.get_alignment_length()
-    #loop over the list of sequences that we're collecting
-    for name in allNames:
-        if name in mydict:
-            rawStrings.setdefault(name, []).append(str(mydict[name].seq))
-        else:
-            rawStrings.setdefault(name, []).append(dummy)
-
-#this is a little cheesy, but find the first alignment that contains each taxon and use the 
-#corresponding SeqRecord as a template to paste the new full alignments into
-finalAlignSeqs = []
-for name in sorted(allNames):
-    for mydict, alignment in alignDicts:
-        if name in mydict:
-            finalSeq = copy.deepcopy(mydict[name])
-            finalSeq._set_seq(Seq.Seq(''.join(rawStrings[name]), finalSeq.seq.alphabet))
-            finalSeq.id = extract_name_with_regex(options.name_pattern, finalSeq.id)
-            finalAlignSeqs.append(finalSeq)
-            break
-
-finalAlign = MultipleSeqAlignment(finalAlignSeqs)
-
-if options.interleave:
-    temp = '.temp.nex'
-    AlignIO.write(finalAlign, temp, "nexus")
-    backIn = Nexus.Nexus(temp)
-    backIn.write_nexus_data(filename=sys.stdout, interleave=True)
-    os.remove(temp)
-else:
-    AlignIO.write(finalAlign, sys.stdout, "nexus")
+#each taxon's row (or block of it if interleaving) is written straight from the spool, with runs 
+#of N for any alignments it is missing from
+write_nexus_matrix(sys.stdout, spool, allNames, interleave=options.block_width if options.interleave else None)
 
 charsetString += charpartString 
 charsetString += ";\nend;\n"
 sys.stdout.write("%s\n" % charsetString)
-
@@ -4,12 +4,18 @@ import re
 from os.path import expandvars
 import copy
 import itertools
+import time
+import multiprocessing
 
 import Bio
 from Bio.SeqFeature import FeatureLocation
 from Bio.SeqRecord import SeqRecord
+from Bio.Seq import UnknownSeq
 import BCBio
-from pygot.utils import read_from_file_or_pickle
+import BCBio.GFF
+from dzutils import read_from_file_or_cache
+from seqstore import PackedGenomeStore, LazySeqDict
+from dzgff import CompactFeatureSet, CompactFeature, FeatureIntervalIndex
 
 #my extensions and functions for working with biopython objects
 
@@ -28,6 +34,18 @@ class TaxonGenomicInformation:
                         existing dict can be passed to __init__, or generated/added to
                         with a passed seq_filename
                         empty if seq_dict or seq_filename not passed to __init__
+                        if indexSeqFile is passed to __init__ the records from seq_filename are 
+                        only read (using a .fai index of the file) as they are accessed, 
+                        and seq_dict is a LazySeqDict
+
+    genome_store    - PackedGenomeStore holding the toplevel sequences if useGenomeStore is 
+                        passed to __init__, otherwise None.  In that case the records in 
+                        toplevel_record_dict and toplevel_record_list are StoredSequenceRecords, 
+                        which only read sequence from the (memory mapped) store when sliced
+
+    gff_feature_set - CompactFeatureSet holding the gff features if compactFeatures is passed to
+                        __init__, otherwise None.  In that case the features in all of the below are
+                        CompactFeatures rather than SeqFeatures
 
     if a gff_filename is passed to __init__, several things happen:
         -gff_seqrecord_list is a list filled with SeqRecords for each feature referenced in the gff
@@ -35,9 +53,18 @@ class TaxonGenomicInformation:
             that are held by the SeqRecords in gff_seqrecord_list
         -toplevel_record_list is updated to have gff features added to the SeqRecords
         -seq_dict is updated with features from gff
+    >>> import tempfile
+    >>> seqFile = tempfile.NamedTemporaryFile(suffix='.fa')
+    >>> seqFile.write('>g1\\nACGT\\n>g2\\nGGCC\\n')
+    >>> seqFile.flush()
+    >>> info = TaxonGenomicInformation('OsativaAA', seq_filename=seqFile.name, indexSeqFile=True)
+    >>> info.seq_dict.__class__.__name__, len(info.seq_dict), str(info.seq_dict['g2'].seq)
+    ('LazySeqDict', 2, 'GGCC')
+    >>> import os
+    >>> os.remove(seqFile.name + '.fai')
     '''
     
-    def __init__(self, name, seq_dict=None, seq_filename=None, toplevel_filename=None, gff_filename=None, usePickle=False):
+    def __init__(self, name, seq_dict=None, seq_filename=None, toplevel_filename=None, gff_filename=None, usePickle=False, useGenomeStore=False, compactFeatures=False, indexSeqFile=False):
         '''
         print '#############'
         print name
@@ -50,20 +77,24 @@ class TaxonGenomicInformation:
         self.name = name
         self.short_name = name[0:7]
         
+        self.genome_store = None
         if toplevel_filename is not None:
             toplevel_filename = expandvars(toplevel_filename)
-            if not usePickle:
+            if useGenomeStore:
+                #nothing but the index is read here, sequence is pulled from the store as features are extracted
+                self.genome_store = PackedGenomeStore(toplevel_filename)
+                self.toplevel_record_dict = self.genome_store.records()
+                self.toplevel_record_list = [ self.toplevel_record_dict[seqid] for seqid in self.genome_store.keys() ]
+            elif not usePickle:
                 #it can be handy to have a dict of the toplevel seq(s) recs which may just be a single chrom
                 self.toplevel_record_dict = Bio.SeqIO.to_dict(Bio.SeqIO.parse(open(toplevel_filename), "fasta"))
                 #pull the toplevel reqs back out as a list of seq recs
                 self.toplevel_record_list = [it[1] for it in self.toplevel_record_dict.iteritems()]
             else:
-                #this is slightly faster reading the pickle than re-parsing
-                self.toplevel_record_list = read_from_file_or_pickle(toplevel_filename, toplevel_filename + '.list.pickle', Bio.SeqIO.parse, "fasta")
-                if not isinstance(self.toplevel_record_list, list):
-                    #it may be an iterator or generator rather than list
-                    self.toplevel_record_list = [ it for it in self.toplevel_record_list ]
-                self.toplevel_record_dict = Bio.SeqIO.to_dict(self.toplevel_record_list)
+                #this is slightly faster reading the cached parse than re-parsing
+                #streaming it avoids holding both a full list and dict of the records while loading
+                self.toplevel_record_dict = Bio.SeqIO.to_dict(read_from_file_or_cache(toplevel_filename, Bio.SeqIO.parse, ("fasta",), stream=True))
+                self.toplevel_record_list = [it[1] for it in self.toplevel_record_dict.iteritems()]
 
             '''
             print '1#####################'
@@ -86,61 +117,51 @@ class TaxonGenomicInformation:
             seq_dict = dict()
         if seq_filename is not None:
             seq_filename = expandvars(seq_filename)
-            if not usePickle:
+            if indexSeqFile:
+                self.seq_dict = LazySeqDict(seq_filename)
+            elif not usePickle:
                 self.seq_dict = Bio.SeqIO.to_dict(Bio.SeqIO.parse(open(seq_filename), "fasta"))
             else:
-                #haven't actually tested pickle here
-                self.seq_dict = Bio.SeqIO.to_dict(read_from_file_or_pickle(seq_filename, Bio.SeqIO.parse, "fasta"))
+                self.seq_dict = Bio.SeqIO.to_dict(read_from_file_or_cache(seq_filename, Bio.SeqIO.parse, ("fasta",), stream=True))
         else:
             self.seq_dict = dict()
         self.seq_dict.update(seq_dict)
 
         if gff_filename is not None:
-            #pickling the gffs doesn't seem to help - pickle file is much larger than actual gff and slower to read
             gff_filename = expandvars(gff_filename)
-            #this will asign features in the gff to the toplevel seqs - the toplevel_record_dict will be unaltered
-            #print len(self.toplevel_record_dict.items())
-            #I think that we can avoid reading this if we don't have toplevels, but it might bork some script
+            #the gff is only parsed once, and the toplevel and seq_dict views are built from that parse
+            #by attaching its features to their records.  The SeqFeature objects are therefore shared
+            #between the views, rather than each view having its own copy as when the gff was parsed 
+            #separately for each of them
+            self.gff_feature_set = None
+            if compactFeatures:
+                self.gff_feature_set = CompactFeatureSet(gff_filename)
+                self.gff_seqrecord_list = compact_feature_seqrecords(self.gff_feature_set)
+            elif usePickle:
+                #with a single parse the cached version is worth it
+                self.gff_seqrecord_list = read_from_file_or_cache(gff_filename, BCBio.GFF.parse)
+            else:
+                self.gff_seqrecord_list = [rec for rec in BCBio.GFF.parse(gff_filename)]
+
+            #this will asign features in the gff to the toplevel seqs
+            #I think that we can avoid doing this if we don't have toplevels, but it might bork some script
             if self.toplevel_record_dict:
-                self.toplevel_record_list = [feat for feat in BCBio.GFF.parse(gff_filename, base_dict=self.toplevel_record_dict)]
+                self.toplevel_record_list = attach_gff_features(self.gff_seqrecord_list, self.toplevel_record_dict)
                 #now assign back to the dict
                 self.toplevel_record_dict = dict([ (top.id, top) for top in self.toplevel_record_list ])
-            '''
-            print '2#####################'
-            for top in self.toplevel_record_list:
-                if top.features:
-                    print len(self.toplevel_record_list)
-                    print type(self.toplevel_record_list)
-                    print top
-                    print len(top.features)
-                    print top.features
-                    break
-            print '/2#####################'
-            '''
-            #print type(self.toplevel)
-            #print len(self.toplevel)
-            #print "SELF.TOPLEVEL"
-            #print self.toplevel[0]
-            #print "/SELF.TOPLEVEL"
-            self.gff_seqrecord_list = [rec for rec in BCBio.GFF.parse(gff_filename)]
-            '''
-            print '3#####################'
-            print len(self.gff_seqrecord_list)
-            for rec in self.gff_seqrecord_list:
-                if rec.features:
-                    print rec
-                    print len(rec.features)
-                    print rec.features
-                    break
-            if len(self.gff_seqrecord_list) > 1:
-                print self.gff_seqrecord_list[1]
-            print '/3#####################'
-            '''
-            self.seq_dict = Bio.SeqIO.to_dict([feat for feat in BCBio.GFF.parse(gff_filename, base_dict=self.seq_dict)])
+            if isinstance(self.seq_dict, LazySeqDict):
+                #only the records that the gff refers to are read from the file to have features added, 
+                #and they go in the overlay, which hides the featureless versions in the file
+                gffSeqids = set(rec.id for rec in self.gff_seqrecord_list)
+                featureRecords = dict( (seqid, self.seq_dict[seqid]) for seqid in gffSeqids if seqid in self.seq_dict )
+                for rec in attach_gff_features(self.gff_seqrecord_list, featureRecords):
+                    self.seq_dict[rec.id] = rec
+            else:
+                self.seq_dict = Bio.SeqIO.to_dict(attach_gff_features(self.gff_seqrecord_list, self.seq_dict))
 
         else:
+            self.gff_feature_set = None
             self.gff_seqrecord_list = []
-            self.seq_dict = dict()
 
         if toplevel_filename is not None and gff_filename is not None:
             self.feature_to_toplevel_record_dict = dict()
@@ -171,6 +192,13 @@ class TaxonGenomicInformation:
         print '%s\t%d features\t%d dictFeatures\t%d sequences\t%d toplevel records' % (self.name, 
             len(self.gff_seqrecord_list), len(self.gff_feature_dict.keys()), len(self.seq_dict.keys()), len(self.toplevel_record_list))
 
+    def feature_interval_index(self):
+        '''FeatureIntervalIndex of the toplevel gff features (usually genes) on each seqid, for
+        finding features by coordinate.  Built the first time it is asked for.'''
+        if getattr(self, '_feature_interval_index', None) is None:
+            self._feature_interval_index = FeatureIntervalIndex.from_records(self.gff_seqrecord_list)
+        return self._feature_interval_index
+
     def toplevel_record_for_feature(self, feat):
         if isinstance(feat, str):
             if feat in self.feature_to_toplevel_record_dict:
@@ -185,45 +213,124 @@ class TaxonGenomicInformation:
                 raise ValueError('toplevel for feature named %s not found!' % name)
 
 
-def instantiate_taxon_genomic_information(taxon, gff_filename, usePickle, toplevel_filename=None ):
-    return TaxonGenomicInformation(taxon, gff_filename=gff_filename, toplevel_filename=toplevel_filename, usePickle=False)
+def attach_gff_features(gffRecords, baseDict):
+    '''Equivalent of BCBio.GFF.parse(gff_filename, base_dict=baseDict), but using the records from an
+    earlier parse of the gff rather than parsing it again.  Returns a record for every one in baseDict
+    and for every gff seqid that isn't in it, sorted by id, as BCBio does.  As with BCBio the records in 
+    baseDict aren't changed, and the features of each gff record are added to a copy of the baseDict 
+    record with the same id (or to a new record with the gff record's sequence).  Unlike BCBio the copies 
+    are shallow, so the (possibly large) sequences are shared with the baseDict records rather than 
+    duplicated, and the features are shared with the gff records.
+    >>> import tempfile
+    >>> from Bio.Seq import Seq
+    >>> gffFile = tempfile.NamedTemporaryFile(suffix='.gff')
+    >>> gffFile.write('##gff-version 3\\nchr1\\t.\\tgene\\t1\\t2\\t.\\t+\\t.\\tID=g1\\n')
+    >>> gffFile.flush()
+    >>> base = { 'chr1':SeqRecord(Seq('ACGT'), id='chr1'), 'chr2':SeqRecord(Seq('GG'), id='chr2') }
+    >>> attached = attach_gff_features(BCBio.GFF.parse(gffFile.name), base)
+    >>> [ (rec.id, len(rec.features), str(rec.seq)) for rec in attached ]
+    [('chr1', 1, 'ACGT'), ('chr2', 0, 'GG')]
+    >>> [ (rec.id, len(rec.features), str(rec.seq), rec.annotations) for rec in attached ] == [ 
+    ...     (rec.id, len(rec.features), str(rec.seq), rec.annotations) for rec in BCBio.GFF.parse(gffFile.name, base_dict=base) ]
+    True
+    >>> len(base['chr1'].features)
+    0
+    '''
+    gffRecords = list(gffRecords)
+    #BCBio adds the gff's directives (e.g. gff-version) to the annotations of every record, with features
+    #or not, and they are what all of the gff records have in common
+    directives = {}
+    if gffRecords:
+        directives = dict( (key, val) for key, val in gffRecords[0].annotations.iteritems() 
+                if all(rec.annotations.get(key) == val for rec in gffRecords[1:]) )
+    attached = {}
+    for seqid, base in baseDict.iteritems():
+        rec = copy.copy(base)
+        rec.features = list(base.features)
+        rec.annotations = dict(base.annotations)
+        rec.annotations.update(directives)
+        attached[seqid] = rec
+    for rec in gffRecords:
+        if rec.id in attached:
+            base = attached[rec.id]
+            base.features.extend(rec.features)
+            base.annotations.update(rec.annotations)
+        else:
+            #a new record, so that the feature list isn't shared with the gff record
+            attached[rec.id] = SeqRecord(rec.seq, id=rec.id, name=rec.name, description=rec.description, 
+                    features=list(rec.features), annotations=dict(rec.annotations))
+    return [ attached[seqid] for seqid in sorted(attached) ]
+
+
+def compact_feature_seqrecords(featureSet):
+    '''Make SeqRecords with CompactFeatures attached in the same way that BCBio.GFF.parse returns 
+    SeqRecords with SeqFeatures attached, i.e. one record per seqid, holding its toplevel features'''
+    bySeqid = featureSet.top_level_features_by_seqid()
+    return [ SeqRecord(UnknownSeq(0), id=seqid, name=seqid, features=bySeqid[seqid]) for seqid in featureSet.seqids() ]
+
 
-def get_taxon_genomic_information_dict(source, report=True, readToplevels=True, usePickle=False, useSMP=False):
+def instantiate_taxon_genomic_information(taxon, gff_filename, usePickle, toplevel_filename=None, useGenomeStore=False):
+    return TaxonGenomicInformation(taxon, gff_filename=gff_filename, toplevel_filename=toplevel_filename, usePickle=usePickle, useGenomeStore=useGenomeStore)
+
+
+def _load_taxon_genomic_information(job):
+    '''Load one taxon for get_taxon_genomic_information_dict, possibly in a worker process.
+    Takes a single tuple so it can be used with Pool.imap, and returns the taxon name, 
+    the TaxonGenomicInformation and the number of seconds it took to load.'''
+    taxon, gff_filename, toplevel_filename, usePickle, useGenomeStore = job
+    startTime = time.time()
+    info = instantiate_taxon_genomic_information(taxon, gff_filename, usePickle, toplevel_filename=toplevel_filename, useGenomeStore=useGenomeStore)
+    return taxon, info, time.time() - startTime
+
+
+def get_taxon_genomic_information_dict(source, report=True, readToplevels=True, usePickle=False, useSMP=False, numProcesses=None, useGenomeStore=False):
+    '''Return a dict of taxon names to TaxonGenomicInformation objects, read from a file (or list of lines) 
+    with lines containing short taxon identifiers, sequence files, gff files and toplevel files for each taxon.
+    
+    With useSMP the taxa are loaded in separate processes (numProcesses of them, default one per cpu) 
+    and the results are pickled back to this one.  Passing useGenomeStore as well is a good idea in that 
+    case, since the toplevel sequences then stay in their memory mapped stores rather than being pickled 
+    and copied back, and are shared between processes.
+    '''
     #file with lines containing short taxon identifiers, sequence files and gff files for 
     #each taxon
     #like this (on one line)
     #ObartAA	blah	/Users/zwickl/Desktop/GarliDEV/experiments/productionOryza2/gramene34_split/gffs/bartAA.fullWithFixes.gff \
         #/Users/zwickl/Desktop/GarliDEV/experiments/productionOryza2/gramene34_split/toplevels/Oryza_barthii-toplevel-20110818.fa
     if isinstance(source, list):
-        masterFilenames = [ s.strip.split() for s in source ] if len(source[0]) == 1 else source
+        masterFilenames = [ s.strip().split() for s in source ] if source and isinstance(source[0], str) else source
     else:
         masterFilenames = [ line.strip().split() for line in open(source, 'rb') if len(line.strip()) > 0 ]
 
+    #ended up not using sequence files, just getting everything from toplevels
+    jobs = [ (taxon[0], taxon[2], taxon[3] if readToplevels else None, usePickle, useGenomeStore) for taxon in masterFilenames ]
+
     allTaxonInfo = {}
-    if useSMP:
-        import pp
-        job_server = pp.Server(2)
-        sys.stderr.write("Starting parallel python with %d workers\n" % job_server.get_ncpus())
-        if not readToplevels:
-            taxon = masterFilenames[0]
-            funcs = [ job_server.submit(instantiate_taxon_genomic_information, (taxon[0], taxon[2], usePickle), (TaxonGenomicInformation, expandvars), ("dzbiopython", "BCBio.GFF", "Bio.SeqIO")) for taxon in masterFilenames[:] ]
-        else:
-            funcs = [ job_server.submit(instantiate_taxon_genomic_information(taxon[0], gff_filename=taxon[2], toplevel_filename=taxon[3], usePickle=usePickle)) for taxon in masterFilenames ]
-        exit('CHECK parallel usage in get_taxon_genomic_information_dict')
-        #can this guarantee that the funcs from the list comp is in the same order as masterFilenames?
-        job_server.wait()
-        for t, i in itertools.izip([ t[0] for t in masterFilenames ], funcs):
-            allTaxonInfo[t] = i()
-        sys.stderr.write("%d done\n" % len(allTaxonInfo))
+    pool = None
+    #with no taxa there is nothing to farm out, and a Pool can't have zero processes
+    if useSMP and jobs:
+        if numProcesses is None:
+            numProcesses = multiprocessing.cpu_count()
+        numProcesses = min(numProcesses, len(jobs))
+        sys.stderr.write("loading %d taxa with %d worker processes\n" % (len(jobs), numProcesses))
+        pool = multiprocessing.Pool(numProcesses)
+        #imap hands back results in the order that the jobs were passed, regardless of which finishes first
+        results = pool.imap(_load_taxon_genomic_information, jobs)
     else:
-        for taxon in masterFilenames:
-            #ended up not using sequence files, just getting everything from toplevels
-            if not readToplevels:
-                allTaxonInfo[ taxon[0] ] = TaxonGenomicInformation(taxon[0], gff_filename=taxon[2], usePickle=usePickle)
-            else:
-                allTaxonInfo[ taxon[0] ] = TaxonGenomicInformation(taxon[0], gff_filename=taxon[2], toplevel_filename=taxon[3], usePickle=usePickle)
+        results = itertools.imap(_load_taxon_genomic_information, jobs)
+
+    try:
+        for taxon, info, elapsed in results:
+            allTaxonInfo[taxon] = info
             if report:
-                allTaxonInfo[ taxon[0] ].output()
+                info.output()
+                sys.stderr.write("%s loaded in %.1f seconds\n" % (taxon, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if useSMP:
+        sys.stderr.write("%d done\n" % len(allTaxonInfo))
     return allTaxonInfo
 
 
@@ -253,6 +360,8 @@ def int_feature_location(feat):
     '''Deals with the annoying fact that hoops must be jumped through to make FeatureLocations into numbers
     NOTE: returns location coords in standard biopython format, with start counting from zero, and
     end being one PAST the last base'''
+    if isinstance(feat, CompactFeature):
+        return feat.int_location()
     return (feat.location.start.position, feat.location.end.position)
 
 
@@ -311,7 +420,21 @@ def extract_seqrecord_between_outer_cds(rec, ifeat):
     last cds of a gene, mainly as a way to chop off any
     UTRs.  This does NOT preperly set the features of the
     returned SeqRecord.
+    >>> import os, shutil, tempfile
+    >>> tempDir = tempfile.mkdtemp()
+    >>> open(os.path.join(tempDir, 'top.fa'), 'w').write('>chr1\\nACGTACGTAC\\n')
+    >>> open(os.path.join(tempDir, 'top.gff'), 'w').write('chr1\\t.\\tgene\\t2\\t9\\t.\\t+\\t.\\tID=gene1\\n'
+    ...     'chr1\\t.\\tmRNA\\t2\\t9\\t.\\t+\\t.\\tID=mrna1;Parent=gene1\\nchr1\\t.\\tCDS\\t3\\t8\\t.\\t+\\t0\\tID=cds1;Parent=mrna1\\n')
+    >>> info = TaxonGenomicInformation('OsativaAA', toplevel_filename=os.path.join(tempDir, 'top.fa'), 
+    ...     gff_filename=os.path.join(tempDir, 'top.gff'), useGenomeStore=True, compactFeatures=True)
+    >>> str(extract_seqrecord_between_outer_cds(info.toplevel_record_dict['chr1'], info.gff_feature_dict['gene1']).seq)
+    start, end 2 9
+    'GTACGTA'
+    >>> shutil.rmtree(tempDir)
     '''
+    if isinstance(ifeat, CompactFeature):
+        #this needs real SeqFeatures that can be copied and altered
+        ifeat = ifeat.to_seqfeature()
     if ifeat.sub_features[0].type.lower() == 'mrna':
         if len(ifeat.sub_features) > 1 and ifeat.sub_features[1].type.lower() == 'mrna':
             raise ValueError('Multiple mRNA features found! Pass only one.')
@@ -543,8 +666,11 @@ def make_gene_order_map(geneOrderFilename):
 
 
 def adjust_feature_coords(features, delta):
-    '''Shift all feature and subfeature coords by delta'''
-    for feature in features:
+    '''Shift all feature and subfeature coords by delta.  CompactFeatures can't be changed, so they are 
+    replaced in the list with shifted SeqFeatures.'''
+    for num, feature in enumerate(features):
+        if isinstance(feature, CompactFeature):
+            feature = features[num] = feature.to_seqfeature()
         start, end = feature.location.start.position + delta, feature.location.end.position + delta
         feature.location = FeatureLocation(start, end)
         adjust_feature_coords(feature.sub_features, delta)
@@ -591,6 +717,8 @@ def remove_stop_codon_from_feature(feature):
     '''this just chops off the last three bases of the gene, adjusting gene, mRNA, CDS and exon locations
     it is a simpler version of adjust_for_out_of_phase_cds'''
     assert feature.type == 'gene'
+    if isinstance(feature, CompactFeature):
+        raise ValueError('CompactFeatures can\'t be changed, make a SeqFeature with to_seqfeature first')
 
     start, end = int_feature_location(feature)
     adjust = (end, end - 3) if feature.strand == 1 else (start, start + 3)
@@ -642,3 +770,7 @@ def substitute_feature_names(feature, oldName, newName):
         exit('MULTIPLE PARENTS?')
 
 
+if __name__ == "__main__":
+    import doctest
+    import Bio.SeqIO
+    doctest.testmod()
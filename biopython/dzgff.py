@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from urllib import unquote
+
+#light weight gff3 handling that doesn't build biopython objects unless asked to.
+#coordinates are converted to biopython style, with start counting from zero and
+#end being one PAST the last base
+
+
+def parse_gff_attributes(field):
+    '''Parse the ninth (attributes) column of a gff3 line into a dict of lists of strings,
+    as BCBio puts in SeqFeature.qualifiers.
+    >>> sorted(parse_gff_attributes('ID=13103.m00215;Parent=13103.t00151,x;Alias=LOC_Os03g02540.1').items())
+    [('Alias', ['LOC_Os03g02540.1']), ('ID', ['13103.m00215']), ('Parent', ['13103.t00151', 'x'])]
+    >>> parse_gff_attributes('Name=proteasome%20subunit%2C%20putative;')
+    {'Name': ['proteasome subunit, putative']}
+    '''
+    quals = {}
+    for part in field.strip().split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            key, val = part.split('=', 1)
+        else:
+            key, val = part, 'true'
+        quals.setdefault(unquote(key), []).extend(unquote(v) for v in val.split(','))
+    return quals
+
+
+def split_gff_line(line):
+    '''Return the nine fields of a gff3 feature line, or None for comments, directives and
+    blank lines.
+    >>> split_gff_line('Chr3\\tMSU_osa1r6\\tCDS\\t937701\\t938087\\t.\\t-\\t0\\tParent=13103.m00215\\n')[2:5]
+    ['CDS', '937701', '938087']
+    >>> split_gff_line('##gff-version 3\\n') is None
+    True
+    '''
+    if not line.strip() or line.startswith('#'):
+        return None
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) != 9:
+        raise ValueError('gff line does not have 9 tab separated fields: %s' % line)
+    return fields
+
+
+def gff_line_qualifiers(fields):
+    '''Qualifiers for a split gff3 line, as BCBio would make them: the attributes plus the source, 
+    and the score and phase if they are given'''
+    quals = parse_gff_attributes(fields[8])
+    quals['source'] = [ fields[1] ]
+    if fields[5] != '.':
+        quals['score'] = [ fields[5] ]
+    if fields[7] != '.':
+        quals['phase'] = [ fields[7] ]
+    return quals
+
+
+class GffBlock(object):
+    '''The lines for one toplevel feature (usually a gene) and all of its descendants.
+    fields are the split fields of the toplevel line, and start and end are in gff coordinates
+    (start at 1, end included) and cover the descendants too.'''
+    def __init__(self, fields, line):
+        self.fields = fields
+        self.seqid = fields[0]
+        self.start, self.end = int(fields[3]), int(fields[4])
+        self.lines = [ line ]
+        self.ids = []
+
+    def qualifiers(self):
+        return gff_line_qualifiers(self.fields)
+
+    def add(self, fields, line):
+        self.lines.append(line)
+        self.end = max(self.end, int(fields[4]))
+
+
+def _gff_ids_and_parents(attributes):
+    featId, parents = None, []
+    for part in attributes.split(';'):
+        part = part.strip()
+        if part.startswith('ID='):
+            featId = unquote(part[3:])
+        elif part.startswith('Parent='):
+            parents = [ unquote(par) for par in part[7:].split(',') ]
+    return featId, parents
+
+
+def iterate_gff_blocks(lines, spanningTypes=('chromosome', 'contig', 'scaffold')):
+    '''Generator that groups gff3 lines into GffBlocks of a toplevel feature and its descendants
+    (linked by ID and Parent), yielding each block as soon as it is known to be complete, in the 
+    order the toplevel features appear.  Only the blocks that might still get lines are held.
+
+    A block is taken to be complete at a ### directive, at the end of the input, or when a toplevel
+    feature starts on another seqid or past the end of the block.  This assumes what essentially every
+    gff does, i.e. that descendants come after their parent and before anything on a different seqid 
+    or further along.  Descendants of a feature whose block was already passed on can't be grouped 
+    with it, so are output as a block of their own with a warning.  A feature with multiple parents 
+    goes into the block of the first.  Toplevel features of the types in spanningTypes, which cover 
+    the whole seqid, are yielded as blocks of their own as soon as they are read, since otherwise 
+    every block after them on the seqid would be held until the end of the seqid.
+    >>> lines = (['Chr1\\tMSU\\tchromosome\\t1\\t1000\\t.\\t.\\t.\\tID=Chr1\\n',
+    ...     'Chr1\\tMSU\\tgene\\t10\\t100\\t.\\t+\\t.\\tID=g1\\n', 'Chr1\\tMSU\\tmRNA\\t10\\t100\\t.\\t+\\t.\\tID=m1;Parent=g1\\n',
+    ...     'Chr1\\tMSU\\tgene\\t200\\t300\\t.\\t+\\t.\\tID=g2\\n', 'Chr1\\tMSU\\tmRNA\\t200\\t300\\t.\\t+\\t.\\tID=m2;Parent=g2\\n',
+    ...     'Chr1\\tMSU\\tgene\\t400\\t500\\t.\\t+\\t.\\tID=g3\\n'])
+    >>> read = []
+    >>> blocks = iterate_gff_blocks(read.append(line) or line for line in lines)
+    >>> [ (block.fields[2], len(block.lines)) for block in (next(blocks), next(blocks)) ]
+    [('chromosome', 1), ('gene', 2)]
+    >>> len(read)
+    4
+    >>> [ (block.fields[2], len(block.lines)) for block in blocks ]
+    [('gene', 2), ('gene', 1)]
+    '''
+    openBlocks = []
+    idToBlock = {}
+
+    def flush(keepFrom=None):
+        #flush complete blocks from the front, keeping file order
+        while openBlocks and (keepFrom is None or openBlocks[0].seqid != keepFrom[0] or openBlocks[0].end < keepFrom[1]):
+            done = openBlocks.pop(0)
+            for featId in done.ids:
+                idToBlock.pop(featId, None)
+            yield done
+
+    for line in lines:
+        if line.startswith('#'):
+            if line.startswith('###'):
+                for block in flush():
+                    yield block
+            elif line.startswith('##FASTA'):
+                break
+            continue
+        fields = split_gff_line(line)
+        if fields is None:
+            continue
+        featId, parents = _gff_ids_and_parents(fields[8])
+        block = idToBlock.get(parents[0]) if parents else None
+        if block is not None:
+            block.add(fields, line)
+        else:
+            if parents:
+                sys.stderr.write('parent %s not found in current gff blocks, outputting feature on its own\n' % parents[0])
+            for done in flush(keepFrom=(fields[0], int(fields[3]))):
+                yield done
+            block = GffBlock(fields, line)
+            if not parents and fields[2].lower() in spanningTypes:
+                yield block
+                continue
+            openBlocks.append(block)
+        if featId is not None:
+            idToBlock[featId] = block
+            block.ids.append(featId)
+
+    for block in flush():
+        yield block
+
+
+_strandCodes = {'+':1, '-':-1}
+
+
+class CompactFeatureSet(object):
+    '''All of the features of a gff3 file, stored column-wise.  Coordinates, strands and
+    parent links are in arrays, seqids, sources and types are interned into tables, and the
+    attributes column is kept as the raw string and only parsed when a feature's qualifiers
+    are asked for.  This is a small fraction of the memory of the equivalent biopython
+    SeqFeature trees.
+
+    Individual features are accessed as CompactFeature objects, which are just a reference
+    to the set and an index, so are made as they are needed.  They have the same attributes
+    that the functions in dzbiopython use (type, strand, id, qualifiers, sub_features), and
+    can be converted to a SeqFeature with to_seqfeature().
+
+    Features with multiple Parents appear as a subfeature of each of them, as with BCBio.
+    '''
+    def __init__(self, filename=None):
+        self.seqid_names, self.source_names, self.type_names = [], [], []
+        self._interned = ({}, {}, {})
+        self.seqid_codes = array('i')
+        self.source_codes = array('i')
+        self.type_codes = array('i')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.strands = array('b')
+        self.phases = array('b')
+        #scores are almost always '.', and are otherwise kept as strings as BCBio does
+        self.scores = {}
+        self.attributes = []
+        self.id_to_index = {}
+        self.top_level = array('l')
+        #children of feature i are child_indices[child_offsets[i]:child_offsets[i + 1]]
+        self.child_offsets = array('l')
+        self.child_indices = array('l')
+        self._parent_names = []
+        if filename is not None:
+            with open(filename, 'rb') as gffIn:
+                self.add_lines(gffIn)
+            self.finish()
+
+    def _intern(self, which, names, string):
+        table = self._interned[which]
+        try:
+            return table[string]
+        except KeyError:
+            table[string] = len(names)
+            names.append(string)
+            return table[string]
+
+    def add_lines(self, lines):
+        for line in lines:
+            if line.startswith('##FASTA'):
+                break
+            fields = split_gff_line(line)
+            if fields is not None:
+                self.add_fields(fields)
+
+    def add_fields(self, fields):
+        index = len(self.starts)
+        self.seqid_codes.append(self._intern(0, self.seqid_names, fields[0]))
+        self.source_codes.append(self._intern(1, self.source_names, fields[1]))
+        self.type_codes.append(self._intern(2, self.type_names, fields[2]))
+        self.starts.append(int(fields[3]) - 1)
+        self.ends.append(int(fields[4]))
+        self.strands.append(_strandCodes.get(fields[6], 0))
+        self.phases.append(int(fields[7]) if fields[7] in ('0', '1', '2') else -1)
+        if fields[5] != '.':
+            self.scores[index] = fields[5]
+        attr = fields[8]
+        self.attributes.append(attr)
+        #only the ID and Parent attributes are needed now, so avoid a full parse
+        for part in attr.split(';'):
+            if part.startswith('ID='):
+                self.id_to_index[unquote(part[3:])] = index
+            elif part.startswith('Parent='):
+                for parent in part[7:].split(','):
+                    self._parent_names.append((index, unquote(parent)))
+        return index
+
+    def finish(self):
+        '''Resolve parent links once all lines are added.  Parents may appear after their children.'''
+        numFeats = len(self.starts)
+        links = []
+        hasParent = array('b', [0]) * numFeats
+        for child, parentName in self._parent_names:
+            parent = self.id_to_index.get(parentName)
+            if parent is None:
+                sys.stderr.write('parent %s of feature %d not found, treating it as toplevel\n' % (parentName, child))
+            else:
+                links.append((parent, child))
+                hasParent[child] = 1
+        self._parent_names = []
+        #stable sort keeps children in file order
+        links.sort(key=lambda link:link[0])
+        self.child_offsets = array('l', [0]) * (numFeats + 1)
+        for parent, child in links:
+            self.child_offsets[parent + 1] += 1
+        for i in xrange(numFeats):
+            self.child_offsets[i + 1] += self.child_offsets[i]
+        self.child_indices = array('l', [ child for parent, child in links ])
+        self.top_level = array('l', [ i for i in xrange(numFeats) if not hasParent[i] ])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def feature(self, index):
+        return CompactFeature(self, index)
+
+    def feature_by_id(self, featId):
+        return CompactFeature(self, self.id_to_index[featId])
+
+    def children(self, index):
+        return self.child_indices[self.child_offsets[index]:self.child_offsets[index + 1]]
+
+    def top_level_features(self, seqid=None):
+        '''CompactFeatures for features without parents (usually genes, and possibly chromosomes),
+        in file order, optionally only those on seqid'''
+        if seqid is None:
+            return [ CompactFeature(self, i) for i in self.top_level ]
+        code = self._interned[0].get(seqid)
+        return [ CompactFeature(self, i) for i in self.top_level if self.seqid_codes[i] == code ]
+
+    def top_level_features_by_seqid(self):
+        '''dict of seqid to list of toplevel CompactFeatures on it, in file order'''
+        bySeqid = dict( (seqid, []) for seqid in self.seqid_names )
+        for i in self.top_level:
+            bySeqid[self.seqid_names[self.seqid_codes[i]]].append(CompactFeature(self, i))
+        return bySeqid
+
+    def seqids(self):
+        '''seqids in the order first seen in the file'''
+        return list(self.seqid_names)
+
+
+class CompactFeature(object):
+    '''View of a single feature in a CompactFeatureSet'''
+    __slots__ = ('feature_set', 'index')
+    #SeqFeature attributes that SeqRecord slicing looks at.  gff features never refer to other sequences
+    ref = None
+    ref_db = None
+
+    def __init__(self, feature_set, index):
+        self.feature_set = feature_set
+        self.index = index
+
+    def __getstate__(self):
+        #needed to pickle a class with __slots__ using the older pickle protocols
+        return (self.feature_set, self.index)
+
+    def __setstate__(self, state):
+        self.feature_set, self.index = state
+
+    @property
+    def type(self):
+        return self.feature_set.type_names[self.feature_set.type_codes[self.index]]
+
+    @property
+    def seqid(self):
+        return self.feature_set.seqid_names[self.feature_set.seqid_codes[self.index]]
+
+    @property
+    def start(self):
+        return self.feature_set.starts[self.index]
+
+    @property
+    def end(self):
+        return self.feature_set.ends[self.index]
+
+    @property
+    def strand(self):
+        return self.feature_set.strands[self.index] or None
+
+    def int_location(self):
+        return (self.feature_set.starts[self.index], self.feature_set.ends[self.index])
+
+    @property
+    def location(self):
+        '''biopython FeatureLocation, made when asked for so that code expecting SeqFeatures (e.g. sorting
+        or slicing of SeqRecords) works.  Changing it does not change the feature.'''
+        from Bio.SeqFeature import FeatureLocation
+        return FeatureLocation(self.start, self.end, self.strand)
+
+    def _shift(self, offset):
+        #what SeqRecord slicing uses to move features into the slice, which gives a SeqFeature here
+        return self.to_seqfeature()._shift(offset)
+
+    @property
+    def qualifiers(self):
+        '''Parsed from the attributes column every time it is asked for, plus source, score and
+        phase as BCBio adds them.  Changing the returned dict does not change the feature.'''
+        fs, index = self.feature_set, self.index
+        quals = parse_gff_attributes(fs.attributes[index])
+        quals['source'] = [ fs.source_names[fs.source_codes[index]] ]
+        if index in fs.scores:
+            quals['score'] = [ fs.scores[index] ]
+        if fs.phases[index] >= 0:
+            quals['phase'] = [ str(fs.phases[index]) ]
+        return quals
+
+    @property
+    def id(self):
+        return self.qualifiers.get('ID', [''])[0]
+
+    @property
+    def sub_features(self):
+        return [ CompactFeature(self.feature_set, child) for child in self.feature_set.children(self.index) ]
+
+    def __eq__(self, other):
+        return isinstance(other, CompactFeature) and self.index == other.index and self.feature_set is other.feature_set
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.feature_set), self.index))
+
+    def __repr__(self):
+        return 'CompactFeature(%s %s:%d-%d %s)' % (self.type, self.seqid, self.start, self.end, self.id)
+
+    def to_seqfeature(self):
+        '''Make an equivalent biopython SeqFeature, including all subfeatures'''
+        from Bio.SeqFeature import SeqFeature, FeatureLocation
+        feat = SeqFeature(FeatureLocation(self.start, self.end), type=self.type, strand=self.strand,
+                id=self.id, qualifiers=self.qualifiers)
+        feat.sub_features = [ sub.to_seqfeature() for sub in self.sub_features ]
+        return feat
+
+
+def feature_coordinates(feat):
+    '''(start, end) of a CompactFeature or biopython SeqFeature, biopython style'''
+    if isinstance(feat, CompactFeature):
+        return feat.int_location()
+    return (feat.location.start.position, feat.location.end.position)
+
+
+class _IntervalTree(object):
+    '''Static augmented interval tree over the intervals on one sequence.  The intervals are 
+    sorted by start and the tree is implicit in the sorted array (as in Heng Li's cgranges): 
+    the node at index i is at level equal to the number of trailing 1 bits in i, and 
+    max_ends[i] is the largest end in the subtree rooted there.  Overlap queries are 
+    O(log n + k), with small subtrees scanned linearly.
+    '''
+    def __init__(self, intervals):
+        intervals.sort(key=lambda it:(it[0], it[1]))
+        self.starts = array('l', [ it[0] for it in intervals ])
+        self.ends = array('l', [ it[1] for it in intervals ])
+        self.items = [ it[2] for it in intervals ]
+        #for nearest queries that need to look leftward
+        byEnd = sorted(xrange(len(intervals)), key=lambda i:self.ends[i])
+        self.ends_sorted = array('l', [ self.ends[i] for i in byEnd ])
+        self.by_end = array('l', byEnd)
+        self.max_level = self._index()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _index(self):
+        n, ends = len(self.starts), self.ends
+        if n == 0:
+            return -1
+        maxEnds = self.max_ends = array('l', ends)
+        lastI, last = 0, 0
+        for i in xrange(0, n, 2):
+            lastI, last = i, ends[i]
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in xrange((x << 1) - 1, n, x << 2):
+                #the right child may be off the end of the array, in which case use the max of the
+                #rightmost node
+                right = maxEnds[i + x] if i + x < n else last
+                maxEnds[i] = max(ends[i], maxEnds[i - x], right)
+            lastI = lastI - x if lastI >> k & 1 else lastI + x
+            if lastI < n and maxEnds[lastI] > last:
+                last = maxEnds[lastI]
+            k += 1
+        return k - 1
+
+    def overlapping(self, start, end):
+        '''indices of intervals overlapping [start, end), in order of start'''
+        found = []
+        n = len(self.starts)
+        if n == 0:
+            return found
+        starts, ends, maxEnds = self.starts, self.ends, self.max_ends
+        stack = [ (self.max_level, (1 << self.max_level) - 1, False) ]
+        while stack:
+            k, x, leftDone = stack.pop()
+            if k <= 3:
+                #small subtree, just scan it
+                i = x >> k << k
+                last = min(i + (1 << (k + 1)) - 1, n)
+                while i < last and starts[i] < end:
+                    if start < ends[i]:
+                        found.append(i)
+                    i += 1
+            elif not leftDone:
+                #come back for this node and its right subtree after the left subtree
+                stack.append((k, x, True))
+                left = x - (1 << (k - 1))
+                if left >= n or maxEnds[left] > start:
+                    stack.append((k - 1, left, False))
+            elif x < n and starts[x] < end:
+                if start < ends[x]:
+                    found.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        return found
+
+    def nearest(self, start, end):
+        '''indices of the intervals closest to [start, end), which are the overlapping ones if there 
+        are any, otherwise the closest one(s) to the left and/or right, including all that tie
+        >>> tree = _IntervalTree([(0, 700, 'a'), (100, 700, 'b'), (750, 800, 'c'), (750, 760, 'd'), (900, 950, 'e')])
+        >>> [ tree.items[i] for i in tree.nearest(712, 726) ]
+        ['a', 'b']
+        >>> [ tree.items[i] for i in tree.nearest(730, 740) ]
+        ['d', 'c']
+        >>> [ tree.items[i] for i in tree.nearest(825, 875) ]
+        ['c', 'e']
+        '''
+        found = self.overlapping(start, end)
+        if found or not self.starts:
+            return found
+        candidates = []
+        #the closest on each side, and then any more that are at the same distance
+        left = bisect_right(self.ends_sorted, start) - 1
+        if left >= 0:
+            leftEnd = self.ends_sorted[left]
+            while left >= 0 and self.ends_sorted[left] == leftEnd:
+                candidates.append((start - leftEnd, self.by_end[left]))
+                left -= 1
+        right = bisect_left(self.starts, end)
+        if right < len(self.starts):
+            rightStart = self.starts[right]
+            while right < len(self.starts) and self.starts[right] == rightStart:
+                candidates.append((rightStart - end, right))
+                right += 1
+        best = min(dist for dist, i in candidates)
+        return sorted(i for dist, i in candidates if dist == best)
+
+
+class FeatureIntervalIndex(object):
+    '''Index of features (or anything else with coordinates) on each seqid, built once and then 
+    queried for features overlapping, contained in or nearest to a range in O(log n + k) rather 
+    than by scanning all features.  Use add() for each feature and then index(), or one of the 
+    from_ methods.  Coordinates are biopython style, and results are in order of start coordinate.
+    '''
+    def __init__(self):
+        self._pending = {}
+        self._trees = {}
+
+    def add(self, seqid, start, end, item):
+        self._pending.setdefault(seqid, []).append((start, end, item))
+
+    def add_feature(self, seqid, feat):
+        start, end = feature_coordinates(feat)
+        self.add(seqid, start, end, feat)
+
+    def index(self):
+        for seqid, intervals in self._pending.iteritems():
+            if seqid in self._trees:
+                tree = self._trees[seqid]
+                intervals.extend(zip(tree.starts, tree.ends, tree.items))
+            self._trees[seqid] = _IntervalTree(intervals)
+        self._pending = {}
+        return self
+
+    @classmethod
+    def from_records(cls, records, skipTypes=('chromosome', 'contig', 'scaffold')):
+        '''Index the toplevel features of SeqRecords, e.g. from BCBio.GFF.parse or the 
+        gff_seqrecord_list or toplevel_record_list of a TaxonGenomicInformation'''
+        new = cls()
+        for rec in records:
+            for feat in rec.features:
+                if feat.type.lower() not in skipTypes:
+                    new.add_feature(rec.id, feat)
+        return new.index()
+
+    @classmethod
+    def from_gff_file(cls, filename, skipTypes=('chromosome', 'contig', 'scaffold')):
+        '''Index the toplevel features of a gff3 file, as CompactFeatures'''
+        new = cls()
+        for feat in CompactFeatureSet(filename).top_level_features():
+            if feat.type.lower() not in skipTypes:
+                new.add_feature(feat.seqid, feat)
+        return new.index()
+
+    def seqids(self):
+        return self._trees.keys()
+
+    def _tree(self, seqid):
+        if self._pending:
+            self.index()
+        return self._trees.get(seqid)
+
+    def overlapping(self, seqid, start, end):
+        '''items with any part in [start, end)'''
+        tree = self._tree(seqid)
+        return [ tree.items[i] for i in tree.overlapping(start, end) ] if tree else []
+
+    def contained(self, seqid, start, end):
+        '''items entirely within [start, end)'''
+        tree = self._tree(seqid)
+        if not tree:
+            return []
+        return [ tree.items[i] for i in tree.overlapping(start, end) if tree.starts[i] >= start and tree.ends[i] <= end ]
+
+    def nearest(self, seqid, start, end):
+        '''items overlapping [start, end) if any, otherwise the closest item(s) on either side'''
+        tree = self._tree(seqid)
+        return [ tree.items[i] for i in tree.nearest(start, end) ] if tree else []
+
+    def sorted_items(self, seqid):
+        '''all items on seqid in order of start coordinate, without needing to sort again'''
+        tree = self._tree(seqid)
+        return list(tree.items) if tree else []
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
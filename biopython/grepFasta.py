@@ -1,60 +1,12 @@
 #!/usr/bin/env python
 import sys
-import re
+import hashlib
 import argparse
 
-from Bio import SeqIO
-from Bio.Alphabet import IUPAC
 from dzutils import ParsedSequenceDescription
-from dzutils import read_from_file_or_pickle
-
-
-'''
-#this was just some experimentation with making my own hashes
-#it turns out that __cmp__ also needs to be overridden
-class my_int(int):
-    def __hash__(self):
-        val = 42
-        print "   (in __hash__: %d)" % val
-        return val
-    def __cmp__(self, other):
-        return False
-
-lint = [ 1, 2, 2 ]
-my_lint = [ my_int(i) for i in lint ]
-
-print "lint hash:", lint[0].__hash__()
-print "my_lint hash:", my_lint[0].__hash__()
-
-sint = set( lint )
-print "about to make set"
-my_sint = set (my_lint)
-
-print sint
-print my_sint
-exit()
-
-#s = set( [ my_int(1), my_int(2), my_int(2) ] )
-print s
-'''
-
-class my_SeqRecord(SeqIO.SeqRecord, object):
-    '''
-    def __init__(self, other=None):
-        if other is not None:
-            self = copy.deepcopy(other)
-    '''
-    def __hash__(self):
-        val = hash(str(self.format('fasta')))
-        #print "hashing!: %s" % val
-        return val
-    def __cmp__(self, other):
-        return False
-
-#def add_hash(an_instance):
-#    an_instance.__hash__ = new.instancemethod(my_seqrecord_hash, an_instance, an_instance.__class__)
-
-#add_hash(SeqIO.SeqRecord)
+from dzutils import read_from_file_or_cache, compile_pattern_list
+from seqstore import iterate_fasta_file, write_fasta, FastaIndex
+
 
 #use argparse module to parse commandline input
 parser = argparse.ArgumentParser(description='extract sequences from a fasta file')
@@ -72,11 +24,16 @@ mutExclGroup.add_argument('-sc', '--sort-coord', dest='sortOutputByCoord', actio
                     help='sort sequences by coordinate if embedded in description (default false)')
 
 parser.add_argument('-p', '--pickle', dest='usePickle', action='store_true', default=False,
-                    help='read and write pickled sequence files (<seqfile>.pickle, sometimes faster, default False)')
+                    help='read and write cached parses of the sequence files (see dzutils.ParseCache, sometimes faster, default False)')
 
 parser.add_argument('-ms', '--match-sequence', dest='matchSequence', action='store_true', default=False,
                     help='search through the actual sequences for a match, rather than the sequence names')
 
+parser.add_argument('-x', '--exact-ids', dest='exactIds', action='store_true', default=False,
+                    help='the patterns are exact sequence names (the first word of the description), and those sequences \
+                    are pulled straight out of each file using a samtools style .fai index next to it, which is built the \
+                    first time it is needed.  Much faster than a search for a few sequences from a big file (not with -v or -ms)')
+
 parser.add_argument('--range', dest='baseRange', nargs=2, type=int, default=[1, -1], metavar=('startbase', 'endbase'),
                     help='range of alignment positions to output, start at 1, last position included, -1 for end')
 
@@ -105,88 +62,71 @@ else:
     seqPatterns = [options.pattern]
 seqFiles = options.filenames
 
-compiledPats = []
-for pat in seqPatterns:
-    try:
-        cpat = re.compile(pat)
-        compiledPats.append(cpat)
-    except StandardError:
-        log.write("problem compiling regex pattern %s\n" % pat)
-        exit(1)
+if options.exactIds and (options.invertMatch or options.matchSequence):
+    log.write("-x can't be used with -v or -ms\n")
+    exit(1)
+
+#all of the patterns are checked in one search of each name (or sequence), rather than
+#one search per pattern.  Lists of plain names are matched with an Aho-Corasick automaton
+try:
+    matcher = compile_pattern_list(seqPatterns)
+except ValueError as ex:
+    log.write("%s\n" % ex)
+    exit(1)
+
+def fasta_records(filename):
+    #(header, sequence) tuples, with no SeqRecords made
+    if options.exactIds:
+        index = FastaIndex(filename)
+        return ( (index.header(name), index.fetch(name)) for name in seqPatterns if name in index )
+    if options.usePickle:
+        return read_from_file_or_cache(filename, iterate_fasta_file, stream=True)
+    return iterate_fasta_file(filename)
 
 log.write("Parsing sequence files %s ...\n" % str(seqFiles))
 
-#read the recs from all of the files
-recList = []
-recSet = set()
+#records are written out as soon as they match unless they need to be sorted first.  Identical
+#records (same header and sequence) are only output once, and are recognized by a digest of
+#the two rather than by hashing a formatted copy of the whole record
+seen = set()
+preparedRecs = []
+numMatched = 0
+streamOutput = not (options.sortOutput or options.sortOutputByCoord)
 for oneSeqFile in seqFiles:
     try:
-        #allRecs = [ rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) ]
-        #allRecs = set([ rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) ])
-        #recList.extend([ rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) ])
-        #recList |= set([ rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) ])
-        
-        if not options.usePickle:
-            recList.extend( rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) )
-        else:
-            recList.extend( rec for rec in read_from_file_or_pickle(oneSeqFile, oneSeqFile + '.pickle', SeqIO.parse, "fasta", alphabet=IUPAC.ambiguous_dna) )
-      
-        #recSet |= set([ rec for rec in SeqIO.parse(oneSeqFile, "fasta", alphabet=IUPAC.ambiguous_dna) ])
-    except IOError:
-        log.write("error reading file %s!\n" % oneSeqFile)
-        exit(1)
-    
-    #if sortOutput:
-    #    allRecs.sort(key=lambda x:x.name)
-
-recSet = set( my_SeqRecord(rec.seq, description=rec.description, name=rec.name, id =rec.id) for rec in recList )
-
-if options.invertMatch:
-    matchedRecs = set(recSet)
-else:
-    matchedRecs = set()
-for cpat in compiledPats:
-    for seq in recSet:
-        if options.matchSequence:
-            match = cpat.search(seq.seq.data)
-        else:
-            match = cpat.search(seq.description)
-        if match is not None:
-            if options.invertMatch:
-                if seq in matchedRecs:
-                    matchedRecs.remove(seq)
-            else:
-                matchedRecs.add(seq)
-        '''     
-        if ( match is not None and not invertMatch ) or ( match is None and invertMatch ):
+        for header, seq in fasta_records(oneSeqFile):
+            if not options.exactIds:
+                match = matcher.search(seq if options.matchSequence else header)
+                if (match is None) != options.invertMatch:
+                    continue
+            digest = hashlib.sha1(header + '\n' + seq).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
             #element -1 is the last element, but slicing includes up to but not including the second
             #value.  So, leave it out to get up to the actual end
-            if endBase == -1:
-                matchedRecs.append(seq[startBase:])
+            seq = seq[startBase:] if endBase == -1 else seq[startBase:endBase]
+            numMatched += 1
+            if streamOutput:
+                write_fasta(sys.stdout, header, seq)
             else:
-                matchedRecs.append(seq[startBase:endBase])
-        '''
-
-if endBase == -1:
-    preparedRecs = [ seq[startBase:] for seq in matchedRecs ]
-else:
-    preparedRecs = [ seq[startBase:endBase] for seq in matchedRecs ]
-
-#print ParsedSequenceDescription(preparedRecs[0].description)
+                preparedRecs.append((header, seq))
+    except IOError:
+        log.write("error reading file %s!\n" % oneSeqFile)
+        exit(1)
 
 if options.sortOutput:
     log.write("sorting by sequence name\n")
-    preparedRecs.sort(key=lambda x:x.name)
+    preparedRecs.sort(key=lambda rec:rec[0].split(None, 1)[0] if rec[0] else '')
 elif options.sortOutputByCoord:
     log.write("sorting by sequence start coordinate\n")
-    for rec in preparedRecs:
-        rec.coord_start  = ParsedSequenceDescription(rec.description).coord_start
-    preparedRecs.sort(key=lambda x:x.coord_start)
+    preparedRecs.sort(key=lambda rec:ParsedSequenceDescription(rec[0]).coord_start)
 
-if matchedRecs:
-    log.write("matched %d sequences in %s\n" % (len(preparedRecs), str(seqFiles)))
-    SeqIO.write(preparedRecs, sys.stdout, "fasta")
+for header, seq in preparedRecs:
+    write_fasta(sys.stdout, header, seq)
+
+if numMatched:
+    log.write("matched %d sequences in %s\n" % (numMatched, str(seqFiles)))
 else:
     log.write("no sequences matched in %s!\n" % str(seqFiles))
 
-
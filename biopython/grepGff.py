@@ -8,8 +8,59 @@ import string
 from BCBio import GFF
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature
-from dzutils import read_from_file_or_pickle
+from dzutils import read_from_file_or_cache
 from dzbiopython import  sort_feature_list, sort_feature_list_by_coordinate
+from dzgff import FeatureIntervalIndex, iterate_gff_blocks
+
+
+def file_lines(filename):
+    with open(filename, 'rb') as gffIn:
+        for line in gffIn:
+            yield line
+
+
+def input_blocks(filenames):
+    '''GffBlocks of each of the files in turn, or of stdin if there are none.  Each file is grouped
+    into blocks separately, so that IDs in one file can't be taken as the parents of features in another'''
+    sources = [ file_lines(filename) for filename in filenames ] if filenames else [ sys.stdin ]
+    for lines in sources:
+        for block in iterate_gff_blocks(lines):
+            yield block
+
+
+def grep_gff_streaming(filenames, compiledPats, base_ranges, invert_match=False, sort=False, sort_coord=False, out=sys.stdout):
+    '''Filter gff3 text directly, without building SeqRecords.  Lines are grouped into blocks of 
+    a toplevel feature and its descendants, and the toplevel feature's qualifiers are matched against 
+    the patterns and its coordinates against the ranges.  Matching blocks are written out verbatim 
+    as soon as they are complete, unless sorting, in which case only the matching blocks are held.
+    '''
+    out.write('##gff-version 3\n')
+    toSort = []
+    numMatched = 0
+    for block in input_blocks(filenames):
+        if block.fields[2].lower() in [ 'chromosome', 'contig', 'scaffold' ]:
+            continue
+        if base_ranges and not any(start < block.start and block.end <= end for start, end in base_ranges):
+            continue
+        quals = block.qualifiers()
+        hit = any(cpat.search(val) for cpat in compiledPats for vals in quals.itervalues() for val in vals)
+        if hit == invert_match:
+            continue
+        numMatched += 1
+        if sort or sort_coord:
+            toSort.append(block)
+        else:
+            out.writelines(block.lines)
+
+    if sort:
+        #as sort_feature_list does, prefer Alias as the name if it is there
+        qual = 'Alias' if toSort and 'Alias' in toSort[0].qualifiers() else 'ID'
+        toSort.sort(key=lambda block:block.qualifiers().get(qual))
+    elif sort_coord:
+        toSort.sort(key=lambda block:(block.seqid, block.start))
+    for block in toSort:
+        out.writelines(block.lines)
+    return numMatched
 
 parser = argparse.ArgumentParser(description='extract records from a gff file')
 
@@ -26,7 +77,7 @@ mutExclGroup.add_argument('-sc', '--sort-coord', action='store_true', default=Fa
                     help='sort the sequences by start coordinatre (default false)')
 
 parser.add_argument('-p', '--pickle', action='store_true', default=False,
-                    help='read and write pickled sequence files (<gfffile>.pickle, sometimes faster, default False)')
+                    help='read and write cached parses of the gff files (see dzutils.ParseCache, sometimes faster, default False)')
 
 parser.add_argument('-f', '--patternfile', type=str, default=None, 
                     help='file from which to read patterns (you must still pass a pattern on the command line, which is ignored)')
@@ -34,8 +85,13 @@ parser.add_argument('-f', '--patternfile', type=str, default=None,
 parser.add_argument('pattern',
                     help='a quoted regular expression to search sequence names for')
 
-parser.add_argument('--range', nargs=2, type=int, default=[1, -1], metavar=('startbase', 'endbase'),
-                    help='only output annotations entirely within these coordinates, start at 1, last position included, -1 for end')
+parser.add_argument('--range', nargs=2, type=int, default=None, action='append', metavar=('startbase', 'endbase'),
+                    help='only output annotations entirely within these coordinates, start at 1, last position included, -1 for end. \
+                            Can be passed multiple times, in which case annotations within any of the ranges are output')
+
+parser.add_argument('--stream', action='store_true', default=False,
+                    help='filter the gff text line by line rather than parsing it with BCBio, which needs much less \
+                            memory and time and allows multiple files.  Matched genes are output verbatim.')
 
 parser.add_argument('filenames', nargs='*', default=[], 
                     help='a list of filenames to search (none for stdin)')
@@ -45,8 +101,8 @@ options = parser.parse_args()
 
 log = sys.stderr
 
-start_base = options.range[0] - 1
-end_base = options.range[1]
+#convert to zero offset, end one past last base
+base_ranges = [ (start - 1, end if end > -1 else sys.maxint) for start, end in options.range ] if options.range else []
 
 if options.patternfile:
     log.write('reading patterns from file %s ...\n' % options.patternfile)
@@ -63,6 +119,13 @@ for pat in seqPatterns:
         log.write("problem compiling regex pattern %s\n" % pat)
         exit(1)
 
+if options.stream:
+    log.write("Streaming gff files %s ...\n" % (str(options.filenames) if options.filenames else 'stdin'))
+    numMatched = grep_gff_streaming(options.filenames, compiledPats, base_ranges, invert_match=options.invert_match, 
+            sort=options.sort, sort_coord=options.sort_coord)
+    log.write("%d toplevel features output\n" % numMatched)
+    sys.exit(0)
+
 log.write("Parsing gff files %s ...\n" % str(options.filenames))
 
 #this is only dealing with a single gff file at the moment
@@ -76,7 +139,7 @@ allNewRecs = []
 if not options.pickle:
     gffRecs = GFF.parse(options.filenames[0])
 else:
-    gffRecs = read_from_file_or_pickle(options.filenames[0], options.filenames[0] + '.pickle', GFF.parse)
+    gffRecs = read_from_file_or_cache(options.filenames[0], GFF.parse, stream=True)
 
 for rec in gffRecs:
     log.write("%s : %d toplevel features \n" % ( rec.name,  len(rec.features)))
@@ -94,10 +157,24 @@ for rec in gffRecs:
         if string.lower(rec.features[0].type) in [ 'chromosome', 'contig', 'scaffold' ]:
             startFeat = 1
 
-        matchedFeats = set(rec.features[startFeat:]) if options.invert_match else set()
+        if base_ranges:
+            #only features within the ranges need to be looked at, and the index finds them without
+            #scanning every feature for each range
+            rangeIndex = FeatureIntervalIndex()
+            for feat in rec.features[startFeat:]:
+                rangeIndex.add_feature(rec.id, feat)
+            candidateFeats = []
+            for start_base, end_base in base_ranges:
+                candidateFeats.extend(rangeIndex.contained(rec.id, start_base, end_base))
+            if len(base_ranges) > 1:
+                candidateFeats = list(set(candidateFeats))
+        else:
+            candidateFeats = rec.features[startFeat:]
+
+        matchedFeats = set(candidateFeats) if options.invert_match else set()
         for cpat in compiledPats:
             #loop over features of the rec
-            for feat in rec.features[startFeat:]:
+            for feat in candidateFeats:
                 hit = False
                 for qual in feat.qualifiers.items():
                     #for a given qualifier the value is a list of strings
@@ -116,15 +193,8 @@ for rec in gffRecs:
                             matchedFeats.add(feat)
                         #either way we can stop looping over patterns
                         break
-        #whatever is in matchedFeats (possibly nothing) can now be added to 
-        #the new rec if it is in the required base range
-        rangeFilteredFeats = set(matchedFeats)
-        for feat in matchedFeats:
-            assert feat.location.start < feat.location.end
-            if feat.location.start.position < start_base or ( feat.location.end.position > end_base and end_base > -1 ):
-                rangeFilteredFeats.remove(feat)
-                log.write('%s matched but not in base range\n' % feat.qualifiers['ID'])
-        newRec.features.extend(list(rangeFilteredFeats))
+        #whatever is in matchedFeats (possibly nothing) can now be added to the new rec
+        newRec.features.extend(list(matchedFeats))
         sort_feature_list(newRec)
     if newRec.features:
         allNewRecs.append(newRec)
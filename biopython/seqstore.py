@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+import sys
+import mmap
+import tempfile
+from UserDict import DictMixin
+from os import path, stat, rename, fdopen, unlink
+
+from Bio.Seq import Seq, reverse_complement
+from Bio.SeqRecord import SeqRecord
+
+#on disk stores of sequences that can be pulled out by name and coordinate without
+#reading whole files or holding whole genomes in memory
+
+
+def iterate_fasta(lines):
+    '''Generator of (header, sequence) string tuples from fasta formatted lines, without 
+    making SeqRecords.  The header is the whole line after the >, as SeqRecord.description 
+    is when read by SeqIO.'''
+    header, chunks = None, []
+    for line in lines:
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(chunks)
+            header, chunks = line[1:].rstrip(), []
+        elif header is not None:
+            chunks.append(line.strip())
+    if header is not None:
+        yield header, ''.join(chunks)
+
+
+def iterate_fasta_file(filename):
+    with open(filename, 'rb') as fastaIn:
+        for rec in iterate_fasta(fastaIn):
+            yield rec
+
+
+def write_fasta(out, header, seq, width=60):
+    '''write a single fasta record, with the sequence wrapped as SeqIO does'''
+    out.write('>%s\n' % header)
+    for start in xrange(0, len(seq), width):
+        out.write(seq[start:start + width])
+        out.write('\n')
+
+
+def read_fai(filename):
+    '''Read a samtools style .fai index, returning a list of tuples of
+    (name, sequence length, byte offset of sequence, bases per line, bytes per line)
+    '''
+    entries = []
+    with open(filename, 'rb') as faiIn:
+        for line in faiIn:
+            fields = line.split('\t')
+            if len(fields) < 5:
+                raise ValueError('malformed line in index %s: %s' % (filename, line))
+            entries.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4])))
+    return entries
+
+
+def write_fai(filename, entries):
+    '''Write index entries (see read_fai) to filename, atomically'''
+    fd, tempName = tempfile.mkstemp(dir=path.dirname(path.abspath(filename)), prefix='.' + path.basename(filename), suffix='.tmp')
+    with fdopen(fd, 'wb') as faiOut:
+        for entry in entries:
+            faiOut.write('%s\t%d\t%d\t%d\t%d\n' % entry)
+    rename(tempName, filename)
+
+
+def is_stale(derivedFilename, sourceFilename):
+    '''True if derivedFilename doesn't exist or is older than sourceFilename'''
+    return not path.exists(derivedFilename) or stat(derivedFilename).st_mtime < stat(sourceFilename).st_mtime
+
+
+class PackedGenomeStore(object):
+    '''Stores a set of sequences from a fasta file (usually the toplevel chromosomes or
+    scaffolds of a genome) at one byte per base, and memory maps them so that any region
+    can be pulled out by (seqid, start, end, strand) without reading whole sequences.
+    Because the store is mapped rather than read, the OS shares the pages between processes
+    and only the regions that are actually accessed are ever in memory.
+
+    The store is built from the fasta the first time it is needed, or whenever the fasta
+    is newer than it.  Files, by default next to the fasta:
+    <fasta>.seqstore      - the sequences, one after another, with no headers or newlines
+    <fasta>.seqstore.fai  - samtools style index of the sequences in the store.  As there are
+                            no newlines bases per line and bytes per line are the sequence length.
+
+    One byte rather than two bit packing is used so that soft masking and ambiguity codes
+    are kept exactly.  Coordinates are zero offset and end is one past the last base, as
+    in biopython.
+    '''
+    def __init__(self, fasta_filename, store_filename=None, rebuild=False):
+        self.fasta_filename = fasta_filename
+        self.store_filename = fasta_filename + '.seqstore' if store_filename is None else store_filename
+        self.index_filename = self.store_filename + '.fai'
+        if rebuild or is_stale(self.store_filename, fasta_filename) or is_stale(self.index_filename, self.store_filename):
+            self.build(fasta_filename, self.store_filename, self.index_filename)
+        self._open()
+
+    def _open(self):
+        entries = read_fai(self.index_filename)
+        self.index = dict( (name, (offset, length)) for name, length, offset, lb, lw in entries )
+        #keep the file order around, since dicts don't
+        self.names = [ entry[0] for entry in entries ]
+        self.handle = open(self.store_filename, 'rb')
+        if path.getsize(self.store_filename):
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            #can't mmap an empty file
+            self.data = ''
+
+    @staticmethod
+    def build(fasta_filename, store_filename, index_filename):
+        sys.stderr.write('building sequence store %s from %s... ' % (store_filename, fasta_filename))
+        entries = []
+        name, start, offset = None, 0, 0
+        fd, tempName = tempfile.mkstemp(dir=path.dirname(path.abspath(store_filename)), prefix='.' + path.basename(store_filename), suffix='.tmp')
+        try:
+            with fdopen(fd, 'wb') as storeOut:
+                with open(fasta_filename, 'rb') as fastaIn:
+                    for line in fastaIn:
+                        if line.startswith('>'):
+                            if name is not None:
+                                entries.append((name, offset - start, start, offset - start, offset - start))
+                            name, start = line[1:].split(None, 1)[0], offset
+                        else:
+                            bases = line.strip()
+                            storeOut.write(bases)
+                            offset += len(bases)
+                if name is not None:
+                    entries.append((name, offset - start, start, offset - start, offset - start))
+        except:
+            unlink(tempName)
+            raise
+        rename(tempName, store_filename)
+        write_fai(index_filename, entries)
+        sys.stderr.write('%d sequences, %d bases\n' % (len(entries), offset))
+
+    def __getstate__(self):
+        #the mapping itself can't be pickled, so just reopen the files on the other side
+        return {'fasta_filename':self.fasta_filename, 'store_filename':self.store_filename, 'index_filename':self.index_filename}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __contains__(self, seqid):
+        return seqid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.names)
+
+    def length(self, seqid):
+        return self.index[seqid][1]
+
+    def fetch(self, seqid, start=0, end=None, strand=1):
+        '''Return the bases from start up to (but not including) end of sequence seqid as a string,
+        reverse complemented if strand is -1.'''
+        try:
+            offset, length = self.index[seqid]
+        except KeyError:
+            raise KeyError('sequence %s not in store %s' % (seqid, self.store_filename))
+        if end is None or end > length:
+            end = length
+        start = max(start, 0)
+        if start >= end:
+            return ''
+        bases = self.data[offset + start:offset + end]
+        return reverse_complement(bases) if strand == -1 else bases
+
+    def seq(self, seqid, start=0, end=None, strand=1):
+        return Seq(self.fetch(seqid, start, end, strand))
+
+    def record(self, seqid):
+        return StoredSequenceRecord(self, seqid)
+
+    def records(self):
+        '''dict of seqid to StoredSequenceRecord for every sequence in the store'''
+        return dict( (seqid, self.record(seqid)) for seqid in self.names )
+
+
+class StoredSeq(object):
+    '''Stands in for a Seq held in a PackedGenomeStore.  Nothing is read from the store until
+    it is indexed or sliced, and slices are returned as normal Seq objects.'''
+    def __init__(self, store, seqid):
+        self.store = store
+        self.seqid = seqid
+        self._length = store.length(seqid)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step == 1:
+                return self.store.seq(self.seqid, start, stop)
+            return Seq(self.store.fetch(self.seqid)[index])
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('index %d out of range for %s' % (index, self.seqid))
+        return self.store.fetch(self.seqid, index, index + 1)
+
+    def __str__(self):
+        return self.store.fetch(self.seqid)
+
+    def tostring(self):
+        return str(self)
+
+    def __repr__(self):
+        return 'StoredSeq(%s, %d bases)' % (self.seqid, self._length)
+
+    def reverse_complement(self):
+        return self.store.seq(self.seqid, strand=-1)
+
+
+class StoredSequenceRecord(SeqRecord):
+    '''SeqRecord whose sequence is a StoredSeq.  Features can be attached to it as usual, and
+    slicing it gives a normal SeqRecord for just that region (with any features fully within
+    the region shifted appropriately, as SeqRecord slicing does), so SeqFeature.extract works
+    on it without the whole sequence being read.'''
+    def __init__(self, store, seqid):
+        SeqRecord.__init__(self, StoredSeq(store, seqid), id=seqid, name=seqid, description=seqid)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.seq[index]
+        start, stop, step = index.indices(len(self))
+        sub = SeqRecord(self.seq[index], id=self.id, name=self.name, description=self.description)
+        if step == 1:
+            for feat in self.features:
+                if start <= feat.location.nofuzzy_start and feat.location.nofuzzy_end <= stop:
+                    sub.features.append(feat._shift(-start))
+        return sub
+
+
+class FastaIndex(object):
+    '''Random access to the records of a fasta file by name, using a samtools style .fai index 
+    (name, sequence length, byte offset of sequence, bases per line, bytes per line) that is
+    built by a single scan the first time it is needed, or whenever the fasta is newer than it.
+    Pulling one record out is then a seek and a read rather than a parse of the whole file.
+    As with samtools, names are the first word of the header and every line of a record but 
+    the last must be the same length, otherwise the file can't be indexed and ValueError is raised.
+    Coordinates are zero offset and end is one past the last base, as in biopython.
+    '''
+    def __init__(self, fasta_filename, index_filename=None, rebuild=False):
+        self.fasta_filename = fasta_filename
+        self.index_filename = fasta_filename + '.fai' if index_filename is None else index_filename
+        if rebuild or is_stale(self.index_filename, fasta_filename):
+            entries = self.build(fasta_filename)
+            try:
+                write_fai(self.index_filename, entries)
+            except (IOError, OSError):
+                sys.stderr.write('unable to write index %s, it will be rebuilt next time\n' % self.index_filename)
+        else:
+            entries = read_fai(self.index_filename)
+        self._set_entries(entries)
+        self.handle = None
+
+    def _set_entries(self, entries):
+        self.entries = entries
+        self.index = dict( (entry[0], entry[1:]) for entry in entries )
+        if len(self.index) != len(entries):
+            raise ValueError('duplicate sequence names in %s' % self.fasta_filename)
+        self.names = [ entry[0] for entry in entries ]
+
+    @staticmethod
+    def build(fasta_filename):
+        '''scan the fasta, returning a list of index entries (see read_fai)'''
+        entries = []
+        offset = 0
+        name = None
+        with open(fasta_filename, 'rb') as fastaIn:
+            for line in fastaIn:
+                if line.startswith('>'):
+                    if name is not None:
+                        entries.append((name, length, seqOffset, lineBases or 0, lineWidth or 0))
+                    words = line[1:].split(None, 1)
+                    name = words[0] if words else ''
+                    seqOffset, length = offset + len(line), 0
+                    lineBases = lineWidth = None
+                    sawShortLine = False
+                elif name is not None:
+                    bases = len(line.rstrip('\r\n'))
+                    if lineBases is None:
+                        lineBases, lineWidth = bases, len(line)
+                    elif sawShortLine or bases > lineBases:
+                        raise ValueError('lines of differing lengths in sequence %s of %s, unable to index it' % (name, fasta_filename))
+                    if bases < lineBases or len(line) != lineWidth:
+                        #only ok for the last line of a record
+                        sawShortLine = True
+                    length += bases
+                offset += len(line)
+        if name is not None:
+            entries.append((name, length, seqOffset, lineBases or 0, lineWidth or 0))
+        return entries
+
+    def __getstate__(self):
+        #the open file can't be pickled, it is reopened when next needed
+        state = dict(self.__dict__)
+        state['handle'] = None
+        return state
+
+    def _file(self):
+        if self.handle is None:
+            self.handle = open(self.fasta_filename, 'rb')
+        return self.handle
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def length(self, name):
+        return self.index[name][0]
+
+    def fetch(self, name, start=0, end=None):
+        '''Return the bases from start up to (but not including) end of sequence name as a string'''
+        try:
+            length, offset, lineBases, lineWidth = self.index[name]
+        except KeyError:
+            raise KeyError('sequence %s not in index of %s' % (name, self.fasta_filename))
+        if end is None or end > length:
+            end = length
+        start = max(start, 0)
+        if start >= end:
+            return ''
+        startByte = offset + (start // lineBases) * lineWidth + start % lineBases
+        endByte = offset + ((end - 1) // lineBases) * lineWidth + (end - 1) % lineBases + 1
+        handle = self._file()
+        handle.seek(startByte)
+        return handle.read(endByte - startByte).replace('\n', '').replace('\r', '')
+
+    def header(self, name):
+        '''Return the full header line of sequence name (without the >), found by reading back 
+        from the start of the sequence, since the index only holds names'''
+        offset = self.index[name][1]
+        handle = self._file()
+        #the header's own newline is the last thing before the sequence
+        end = offset - 1
+        data = ''
+        while True:
+            readStart = max(0, end - 1024)
+            handle.seek(readStart)
+            data = handle.read(end - readStart) + data
+            newline = data.rfind('\n')
+            if newline != -1 or readStart == 0:
+                break
+            end = readStart
+        return data[newline + 1:].rstrip()[1:]
+
+    def record(self, name):
+        '''SeqRecord for sequence name, as SeqIO.parse would have made it'''
+        return SeqRecord(Seq(self.fetch(name)), id=name, name=name, description=self.header(name))
+
+
+class LazySeqDict(DictMixin):
+    '''Dict of name to SeqRecord (as from SeqIO.to_dict) for a fasta file, in which records are only 
+    read from the file (with a FastaIndex) when they are accessed.  Records are kept once read, so 
+    changes to them (e.g. added features) persist.  Assigned records (or ones added with update) 
+    are held in memory and hide any in the file with the same name.
+    '''
+    def __init__(self, fasta_index):
+        if not isinstance(fasta_index, FastaIndex):
+            fasta_index = FastaIndex(fasta_index)
+        self.fasta_index = fasta_index
+        self.overlay = {}
+
+    def __getitem__(self, name):
+        try:
+            return self.overlay[name]
+        except KeyError:
+            if name not in self.fasta_index:
+                raise
+        rec = self.fasta_index.record(name)
+        self.overlay[name] = rec
+        return rec
+
+    def __setitem__(self, name, rec):
+        self.overlay[name] = rec
+
+    def __delitem__(self, name):
+        raise TypeError('records can\'t be removed from a LazySeqDict')
+
+    def __contains__(self, name):
+        return name in self.overlay or name in self.fasta_index
+
+    def __iter__(self):
+        for name in self.fasta_index.names:
+            yield name
+        for name in self.overlay:
+            if name not in self.fasta_index:
+                yield name
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self.fasta_index) + sum(1 for name in self.overlay if name not in self.fasta_index)
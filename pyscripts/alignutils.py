@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+import numpy as np
+from dzutils import read_nexus_matrix
+
+#alignments held as numpy arrays of characters, one byte per character, with vectorized
+#operations on them, rather than as strings that are looped over character by character
+
+NUCLEOTIDES = 'ACGTacgt'
+
+
+def byte_lookup(chars):
+    '''boolean array indexed by byte value, True for the passed characters
+    >>> np.flatnonzero(byte_lookup('AC'))
+    array([65, 67])
+    '''
+    lookup = np.zeros(256, dtype=bool)
+    lookup[np.frombuffer(chars, dtype=np.uint8)] = True
+    return lookup
+
+
+def codon_range_for_column(column):
+    '''1 based (first, last) nucleotide positions of the codon corresponding to amino acid column
+    column (zero offset)
+    >>> codon_range_for_column(0)
+    (1, 3)
+    '''
+    return column * 3 + 1, column * 3 + 3
+
+
+def clean_codon_array(matrix, bases=NUCLEOTIDES, replacement='?'):
+    '''Replace every codon (triplet of columns) in the 2d uint8 array matrix that has some but not all 
+    characters in bases with replacement, in place, and return the number of characters in bases 
+    in each row after doing so.  The number of columns must be a multiple of three.
+    >>> row = np.frombuffer('ACGTN-AAA', dtype=np.uint8).copy()
+    >>> clean_codon_array(row[np.newaxis])
+    array([6])
+    >>> row.tostring()
+    'ACG???AAA'
+    '''
+    ntax, nchar = matrix.shape
+    if nchar % 3:
+        raise ValueError('number of characters (%d) is not a multiple of three' % nchar)
+    #each row as an N x 3 array of codons, so that whole codons are tested at once
+    codons = matrix.reshape(ntax, nchar // 3, 3)
+    basesPerCodon = byte_lookup(bases)[codons].sum(axis=2)
+    partial = (basesPerCodon != 0) & (basesPerCodon != 3)
+    codons[partial] = ord(replacement)
+    if not np.may_share_memory(codons, matrix):
+        #reshape had to copy, so put the changes back
+        matrix[:] = codons.reshape(ntax, nchar)
+    basesPerCodon[partial] = 0
+    return basesPerCodon.sum(axis=1)
+
+
+def iterate_fasta_alignment(filename):
+    '''Generator of (name, sequence) from a fasta file, name being the first word of the header'''
+    name, chunks = None, []
+    with open(filename, 'rb') as fastaIn:
+        for line in fastaIn:
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(chunks)
+                words = line[1:].split(None, 1)
+                name, chunks = words[0] if words else '', []
+            elif name is not None:
+                chunks.append(line.strip())
+    if name is not None:
+        yield name, ''.join(chunks)
+
+
+class CharacterMatrix(object):
+    '''An alignment as a taxa x sites numpy array of uint8 character codes, along with the taxon
+    labels in the same order as the rows.
+    >>> mat = CharacterMatrix.from_rows([('tax1', 'ACGTAA'), ('tax2', 'AC-?AA')])
+    >>> mat.ntax, mat.nchar
+    (2, 6)
+    >>> mat.row('tax2')
+    'AC-?AA'
+    '''
+    def __init__(self, labels, matrix):
+        self.labels = list(labels)
+        self.matrix = matrix
+        if len(self.labels) != matrix.shape[0]:
+            raise ValueError('%d labels for %d rows' % (len(self.labels), matrix.shape[0]))
+        self.label_to_index = dict( (label, num) for num, label in enumerate(self.labels) )
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''make a matrix from (label, sequence string or bytearray) tuples, which must all be the same length'''
+        rows = list(rows)
+        nchar = len(rows[0][1]) if rows else 0
+        matrix = np.empty((len(rows), nchar), dtype=np.uint8)
+        for num, (label, seq) in enumerate(rows):
+            if len(seq) != nchar:
+                raise ValueError('sequence %s is of length %d, expected %d' % (label, len(seq), nchar))
+            matrix[num] = np.frombuffer(seq, dtype=np.uint8)
+        return cls([ row[0] for row in rows ], matrix)
+
+    @classmethod
+    def from_nexus(cls, filename):
+        #bytearray rows go straight into the array without another copy being made
+        with open(filename, 'rb') as nexusFile:
+            return cls.from_rows(read_nexus_matrix(nexusFile, asBytearray=True).iteritems())
+
+    @classmethod
+    def from_fasta(cls, filename):
+        return cls.from_rows(iterate_fasta_alignment(filename))
+
+    @classmethod
+    def read(cls, filename):
+        '''read a nexus or fasta alignment, telling which from the start of the file'''
+        with open(filename, 'rb') as alignIn:
+            start = alignIn.read(1024).lstrip()
+        if start.startswith('>'):
+            return cls.from_fasta(filename)
+        elif start.upper().startswith('#NEXUS'):
+            return cls.from_nexus(filename)
+        raise ValueError('%s doesn\'t look like a nexus or fasta file' % filename)
+
+    @property
+    def ntax(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nchar(self):
+        return self.matrix.shape[1]
+
+    def __len__(self):
+        return self.ntax
+
+    def row(self, label):
+        return self.matrix[self.label_to_index[label]].tostring()
+
+    def rows(self):
+        '''generator of (label, sequence string) tuples'''
+        for label, row in zip(self.labels, self.matrix):
+            yield label, row.tostring()
+
+    def select_columns(self, columns):
+        '''new CharacterMatrix with only the columns selected by a boolean mask or array of indices
+        >>> CharacterMatrix.from_rows([('tax1', 'ACGT')]).select_columns([True, False, False, True]).row('tax1')
+        'AT'
+        '''
+        return CharacterMatrix(self.labels, self.matrix[:, np.asarray(columns)])
+
+    def mask_columns(self, columns, char='?'):
+        '''set all characters in the columns selected by a boolean mask or array of indices to char, in place'''
+        self.matrix[:, np.asarray(columns)] = ord(char)
+
+    def columns_containing(self, chars):
+        '''boolean mask of columns in which any taxon has one of the characters in chars'''
+        return byte_lookup(chars)[self.matrix].any(axis=0)
+
+    def find_columns_with_residue(self, residue):
+        '''zero offset indices of the columns in which any taxon has residue
+        >>> CharacterMatrix.from_rows([('tax1', 'MKXW'), ('tax2', 'XKLW')]).find_columns_with_residue('X')
+        array([0, 2])
+        '''
+        return np.flatnonzero(self.columns_containing(residue))
+
+    def base_counts(self, bases=NUCLEOTIDES):
+        '''number of characters in each row (taxon) that are in bases
+        >>> CharacterMatrix.from_rows([('tax1', 'ACGTN-'), ('tax2', 'ac??AA')]).base_counts()
+        array([4, 4])
+        '''
+        return byte_lookup(bases)[self.matrix].sum(axis=1)
+
+    def clean_codons(self, bases=NUCLEOTIDES, replacement='?'):
+        '''Replace every codon (triplet of columns) that has some but not all characters in bases with
+        replacement, in place, and return the number of characters in bases in each row after doing so.
+        The number of characters must be a multiple of three.
+        >>> mat = CharacterMatrix.from_rows([('tax1', 'ACGTN-AAA'), ('tax2', '---AcA???')])
+        >>> mat.clean_codons()
+        array([6, 3])
+        >>> list(mat.rows())
+        [('tax1', 'ACG???AAA'), ('tax2', '---AcA???')]
+        '''
+        return clean_codon_array(self.matrix, bases, replacement)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
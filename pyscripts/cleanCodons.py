@@ -1,71 +1,66 @@
 #!/usr/bin/env python
 import sys
+import argparse
+import numpy as np
+from alignutils import clean_codon_array, NUCLEOTIDES
 
-onlyCount = None
-if len(sys.argv) > 1:
-	myfile = open(sys.argv[1], 'rU')
-    if len(sys.argv) > 2:
-        onlyCount = sys.argv[2]
-else:
-	print "usage\ncleanCodons.py <myfilename> <only print non ambig base counts>"
-        exit()
+parser = argparse.ArgumentParser(description='replace codons that are partly ambiguous (some but not all of A, C, G or T) \
+        in sequential nexus matrices with ???, and report the number of unambiguous bases in each sequence')
 
-codon = ""
-#bases = {'A':1,'C':1,'G':1,'T':1,'a':1,'c':1,'g':1,'t':1}
-bases = dict.fromkeys(['A', 'C', 'G', 'T', 'a', 'c', 'g', 't'],  1)
-lnum = 0
-ready = 0
-maxBaseCount = 0
-taxonNum = 0
-for l in myfile:
-    if 'matrix' in l.lower():
-        ready = 1
-        print l
-        continue
-    if not ready:
-        print l
-    if ready and not l.isspace():
-        #print l
+parser.add_argument('-c', '--only-count', action='store_true', default=False,
+                    help='only output the non ambiguous base counts, not the cleaned matrix')
+
+parser.add_argument('--suffix', type=str, default=None,
+                    help='write the output for each file to the filename with this appended, rather than to stdout')
+
+parser.add_argument('filenames', nargs='+',
+                    help='nexus files to clean')
+
+options = parser.parse_args()
+
+
+def clean_nexus_file(myfile, out, onlyCount=False):
+    '''stream through a nexus file, writing each line out as it is read with the matrix rows cleaned, 
+    so that only one row is ever in memory'''
+    maxBaseCount = 0
+    taxonNum = 0
+    ready = False
+    for l in myfile:
+        if not ready:
+            out.write(l)
+            if 'matrix' in l.lower():
+                ready = True
+            continue
+        if l.isspace():
+            continue
         if ';' in l:
-            print l
+            out.write(l)
             break
-        taxonNuma += 1
-        baseCount = 0
-        lnum = += 1
-        newline = ""
-        s = l.split()
-        name, line = s[0], s[1]
-        pos = 0
-        while pos < len(line):
-            codon = line[pos:pos+3]
-            num = 0
-            if codon[0] in bases:
-                num = num + 1
-            if codon[1] in bases:
-                num = num + 1
-            if codon[2] in bases:
-                num = num + 1
-                
-            if num != 0 and num != 3:
-                #print num, pos, codon
-                newline += "???"
-            else:
-                newline += codon
-                baseCount += num
-                #print codon
-            #print pos
-            pos = pos + 3
-        if baseCount > maxBaseCount:
-            maxBaseCount = baseCount
+        taxonNum += 1
+        #rsplit, so that quoted names can contain spaces
+        name, line = l.rsplit(None, 1)
+        row = np.frombuffer(line, dtype=np.uint8).copy()
+        try:
+            baseCount = clean_codon_array(row[np.newaxis], NUCLEOTIDES)[0]
+        except ValueError as ex:
+            sys.exit('%s, for taxon %s in %s' % (ex, name, myfile.name))
+        maxBaseCount = max(maxBaseCount, baseCount)
         if onlyCount:
-            print name, "\t[", taxonNum, " ", baseCount, "]"
+            out.write('%s\t[%d %d]\n' % (name, taxonNum, baseCount))
         else:
-            print name, "\t[", taxonNum, " ", baseCount, "]\t", newline
+            out.write('%s\t[%d %d]\t%s\n' % (name, taxonNum, baseCount, row.tostring()))
 
-print "[Max nonambig bases = ", maxBaseCount, "]"
+    out.write('[Max nonambig bases = %d]\n' % maxBaseCount)
 
-if not onlyCount:           
-    for l in myfile:
-        print l
+    if not onlyCount:
+        for l in myfile:
+            out.write(l)
 
-#print "done"
+
+for filename in options.filenames:
+    with open(filename, 'rU') as myfile:
+        if options.suffix is None:
+            clean_nexus_file(myfile, sys.stdout, options.only_count)
+        else:
+            with open(filename + options.suffix, 'w') as out:
+                clean_nexus_file(myfile, out, options.only_count)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+import numpy as np
+import scipy.sparse as sparse
+from dzutils import BlinkCluster, SetOfClusters
+
+#clusterings held as sparse cluster x gene matrices with gene names interned to integers, so that
+#all of the pairwise overlaps between two clusterings come from a single sparse matrix product,
+#rather than from comparing BlinkCluster member sets pair by pair
+
+
+class GeneIndex(object):
+    '''Interns gene names to consecutive integer ids.  Share one between ClusterMatrices that are to be
+    compared, so that the same gene has the same id in each.
+    >>> genes = GeneIndex()
+    >>> genes.ids(['OglabAA03S_FGT0268', 'OrufiAA03S_FGT0184', 'OglabAA03S_FGT0268'])
+    array([0, 1, 0], dtype=int32)
+    >>> genes.names[1], len(genes)
+    ('OrufiAA03S_FGT0184', 2)
+    '''
+    def __init__(self):
+        self.gene_ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.gene_ids
+
+    def id(self, name):
+        geneId = self.gene_ids.get(name)
+        if geneId is None:
+            geneId = self.gene_ids[name] = len(self.names)
+            self.names.append(name)
+        return geneId
+
+    def ids(self, names):
+        return np.array([ self.id(name) for name in names ], dtype=np.int32)
+
+
+def _cluster_members(clust):
+    return clust.cluster_members if isinstance(clust, BlinkCluster) else clust
+
+
+class ClusterMatrix(object):
+    '''A clustering as a CSR matrix with one row per cluster and one column per gene (in gene_index),
+    with a 1 wherever the gene is in the cluster.  clusters can be a SetOfClusters or any sequence of
+    BlinkClusters or lists of member names, which are kept in the clusters member in the same order
+    as the rows.
+    >>> genes = GeneIndex()
+    >>> first = ClusterMatrix([['a', 'b', 'c'], ['d']], genes)
+    >>> second = ClusterMatrix([['a', 'b'], ['c', 'd'], ['e']], genes)
+    >>> first.overlaps(second).toarray()
+    array([[2, 1, 0],
+           [0, 1, 0]], dtype=int32)
+    >>> first.sizes
+    array([3, 1], dtype=int32)
+    '''
+    def __init__(self, clusters, gene_index=None):
+        if isinstance(clusters, SetOfClusters):
+            clusters = clusters.blink_clusters
+        self.clusters = list(clusters)
+        self.gene_index = GeneIndex() if gene_index is None else gene_index
+        indptr = np.zeros(len(self.clusters) + 1, dtype=np.int64)
+        rows = []
+        for num, clust in enumerate(self.clusters):
+            #a member listed twice only counts once
+            row = np.unique(self.gene_index.ids(_cluster_members(clust)))
+            rows.append(row)
+            indptr[num + 1] = indptr[num] + len(row)
+        self.indptr = indptr
+        self.indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        self.sizes = np.diff(indptr).astype(np.int32)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def matrix(self, numGenes=None):
+        '''the cluster x gene CSR matrix, with numGenes columns (by default the number of genes in the
+        gene index, which may have grown since this clustering was added)'''
+        if numGenes is None:
+            numGenes = len(self.gene_index)
+        data = np.ones(len(self.indices), dtype=np.int32)
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=(len(self.clusters), numGenes))
+
+    def member_ids(self, row):
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def members(self, row):
+        names = self.gene_index.names
+        return [ names[geneId] for geneId in self.member_ids(row) ]
+
+    def overlaps(self, other):
+        '''CSR matrix of the number of shared members of every cluster here (rows) with every cluster in
+        other (columns), which must use the same GeneIndex.  Only overlapping pairs are stored.'''
+        if other.gene_index is not self.gene_index:
+            raise ValueError('clusterings to compare must share a GeneIndex')
+        numGenes = len(self.gene_index)
+        return (self.matrix(numGenes) * other.matrix(numGenes).T).tocsr()
+
+    def overlapping_pairs(self, other):
+        '''arrays of (row here, row in other, number of shared members, size here, size in other) for
+        every pair of overlapping clusters'''
+        overlaps = self.overlaps(other).tocoo()
+        return overlaps.row, overlaps.col, overlaps.data, self.sizes[overlaps.row], other.sizes[overlaps.col]
+
+    def subset_pairs(self, other):
+        '''(row here, row in other) for every cluster here that is a subset of (or identical to) one in other'''
+        rows, cols, shared, sizes, otherSizes = self.overlapping_pairs(other)
+        isSubset = shared == sizes
+        return zip(rows[isSubset], cols[isSubset])
+
+    def gene_assignments(self):
+        '''array over all genes in the gene index of the row of the cluster containing each, or -1 for
+        genes not in any cluster here.  For genes in multiple clusters the first is given.'''
+        assignments = np.empty(len(self.gene_index), dtype=np.int64)
+        assignments.fill(-1)
+        #assigned in reverse, so that the last assignment to each gene is from its first cluster
+        assignments[self.indices[::-1]] = np.repeat(np.arange(len(self.clusters)), self.sizes)[::-1]
+        return assignments
+
+
+class ClusteringComparison(object):
+    '''Compares two clusterings (SetOfClusters, e.g. from parse_blink_output and parse_mcl_output, or
+    anything else ClusterMatrix takes), which are held as ClusterMatrices sharing a GeneIndex in first
+    and second.  The overlaps of all pairs of clusters come from the one sparse product in overlaps, so 
+    only pairs that share members are ever looked at, and the time taken is proportional to the total 
+    membership rather than the product of the numbers of clusters.
+    >>> first = SetOfClusters([ BlinkCluster(num, members) for num, members in enumerate([['a', 'b'], ['c', 'd'], ['e', 'f'], ['g']]) ])
+    >>> second = SetOfClusters([ BlinkCluster(num, members) for num, members in enumerate([['a', 'b'], ['c'], ['d'], ['e', 'f', 'g']]) ])
+    >>> comparison = ClusteringComparison(first, second)
+    >>> [ (clust.number, relation) for clust, relation in comparison.classify() ]
+    [(0, 'identical'), (1, 'split'), (2, 'merge'), (3, 'merge')]
+    >>> sorted((clust1.number, clust2.number, relation) for clust1, clust2, shared, relation in comparison.pairs())
+    [(0, 0, 'identical'), (1, 1, 'superset'), (1, 2, 'superset'), (2, 3, 'subset'), (3, 3, 'subset')]
+    >>> round(comparison.adjusted_rand_index(), 3), round(comparison.variation_of_information(), 3)
+    (0.488, 0.471)
+    >>> [ (clust1.number, clust2.number, relation) for clust1, clust2, relation in first.get_clusters_that_are_subsets_and_supersets(second) ]
+    [(1, 1, 'superset'), (1, 2, 'superset'), (2, 3, 'subset'), (3, 3, 'subset')]
+    '''
+    def __init__(self, first, second):
+        genes = GeneIndex()
+        self.first = ClusterMatrix(first, genes)
+        self.second = ClusterMatrix(second, genes)
+        self.overlaps = self.first.overlaps(self.second)
+        self.overlaps.sort_indices()
+        #the number of clusters in first that each cluster in second overlaps
+        self.second_overlap_counts = np.bincount(self.overlaps.indices, minlength=len(self.second))
+
+    @staticmethod
+    def relationship(size1, size2, shared):
+        '''relationship of a cluster of size1 members to one of size2 with shared members in common'''
+        if shared == size1 == size2:
+            return 'identical'
+        elif shared == size1:
+            return 'subset'
+        elif shared == size2:
+            return 'superset'
+        return 'partial'
+
+    def _row_overlaps(self, row):
+        '''list of (row in second, number of shared members) for the clusters overlapping row of first'''
+        start, end = self.overlaps.indptr[row], self.overlaps.indptr[row + 1]
+        return zip(self.overlaps.indices[start:end], self.overlaps.data[start:end])
+
+    def pairs(self):
+        '''generator of (cluster in first, cluster in second, number of shared members, relationship) for every
+        pair of clusters that overlap, relationship being identical, subset, superset or partial, from the point 
+        of view of the cluster in first'''
+        for row, clust in enumerate(self.first.clusters):
+            size = self.first.sizes[row]
+            for col, shared in self._row_overlaps(row):
+                yield clust, self.second.clusters[col], shared, self.relationship(size, self.second.sizes[col], shared)
+
+    def classify(self):
+        '''List of (cluster in first, classification) for every cluster in first, classification being one of
+        identical - a cluster in second has the same members
+        split     - overlaps several clusters in second, all subsets of it
+        merge     - a strict subset of a cluster in second that also overlaps other clusters in first
+        subset    - a strict subset of a cluster in second that overlaps nothing else in first
+        superset  - a strict superset of the one cluster in second that it overlaps
+        partial   - any other overlap
+        unmatched - overlaps nothing in second
+        '''
+        classified = []
+        for row, clust in enumerate(self.first.clusters):
+            size = self.first.sizes[row]
+            overlaps = self._row_overlaps(row)
+            relations = [ self.relationship(size, self.second.sizes[col], shared) for col, shared in overlaps ]
+            if not overlaps:
+                classification = 'unmatched'
+            elif 'identical' in relations:
+                classification = 'identical'
+            elif len(overlaps) > 1 and all(relation == 'superset' for relation in relations):
+                classification = 'split'
+            elif relations == ['subset']:
+                if self.second_overlap_counts[overlaps[0][0]] > 1:
+                    classification = 'merge'
+                else:
+                    classification = 'subset'
+            elif relations == ['superset']:
+                classification = 'superset'
+            else:
+                classification = 'partial'
+            classified.append((clust, classification))
+        return classified
+
+    def _contingency(self):
+        '''COO matrix of counts of genes for each pair of clusters, over all genes in either clustering.  Genes
+        in more than one cluster are counted in the first, and genes not in one clustering are treated as 
+        singletons in it, which are the rows or columns past its clusters.'''
+        labels1 = self.first.gene_assignments()
+        labels2 = self.second.gene_assignments()
+        genes = np.flatnonzero((labels1 >= 0) | (labels2 >= 0))
+        labels1, labels2 = labels1[genes], labels2[genes]
+        singles = np.arange(len(genes))
+        labels1 = np.where(labels1 >= 0, labels1, len(self.first) + singles)
+        labels2 = np.where(labels2 >= 0, labels2, len(self.second) + singles)
+        counts = sparse.coo_matrix((np.ones(len(genes)), (labels1, labels2)), 
+                shape=(len(self.first) + len(genes), len(self.second) + len(genes)))
+        #summing the counts for each pair
+        return counts.tocsr().tocoo()
+
+    def adjusted_rand_index(self):
+        '''adjusted Rand index of the two clusterings, 1 if identical, around 0 for unrelated'''
+        counts = self._contingency()
+        num = counts.data.sum()
+        pairs = lambda n:n * (n - 1) / 2.0
+        index = pairs(counts.data).sum()
+        rowPairs = pairs(np.asarray(counts.sum(axis=1))).sum()
+        colPairs = pairs(np.asarray(counts.sum(axis=0))).sum()
+        expected = rowPairs * colPairs / pairs(num) if num > 1 else 0.0
+        maximum = (rowPairs + colPairs) / 2.0
+        if maximum == expected:
+            return 1.0
+        return (index - expected) / (maximum - expected)
+
+    def variation_of_information(self):
+        '''variation of information between the two clusterings (in nats), 0 if identical'''
+        counts = self._contingency()
+        num = counts.data.sum()
+        if not num:
+            return 0.0
+        rowSums = np.asarray(counts.sum(axis=1)).ravel()[counts.row]
+        colSums = np.asarray(counts.sum(axis=0)).ravel()[counts.col]
+        return -(counts.data * (np.log(counts.data / rowSums) + np.log(counts.data / colSums))).sum() / num
+
+    def summary(self):
+        '''dict of each classification (see classify) to the number of clusters in first with it'''
+        summary = {}
+        for clust, classification in self.classify():
+            summary[classification] = summary.get(classification, 0) + 1
+        return summary
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 import sys
 import re
-from os import path, stat
+from os import path, stat, environ, makedirs, fdopen, rename, utime, unlink, listdir
 import cPickle
-from collections import Iterable
+import hashlib
+import inspect
+import tempfile
+import struct
+import heapq
+from array import array
+from collections import Iterable, deque, OrderedDict
 from itertools import izip, combinations
 from argparse import ArgumentTypeError, ArgumentParser
 
@@ -105,6 +111,114 @@ def find_shortest_unique_leading_substrings(string_list):
 
 
 
+class AhoCorasickMatcher(object):
+    '''Finds whether any of a set of literal strings occurs in a string, in time proportional 
+    to the length of the string no matter how many literals there are.  search() mimics a 
+    compiled regex in returning None if nothing matches, but returns the matched literal 
+    rather than a match object.
+    >>> matcher = AhoCorasickMatcher(['OglabAA03S_FGT0268', 'FGT1690', 'GT16'])
+    >>> matcher.search('ObartAA03S_FGT1690 seq=cds')
+    'GT16'
+    >>> print matcher.search('ObartAA03S_FGT1790')
+    None
+    '''
+    def __init__(self, literals):
+        #a trie of the literals, with failure links to the longest proper suffix also in the trie
+        self.goto, self.fail, self.out = [{}], [0], [None]
+        for lit in literals:
+            node = 0
+            for char in lit:
+                nextNode = self.goto[node].get(char)
+                if nextNode is None:
+                    nextNode = len(self.goto)
+                    self.goto[node][char] = nextNode
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                node = nextNode
+            if self.out[node] is None:
+                self.out[node] = lit
+
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].iteritems():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.out[child] is None:
+                    self.out[child] = self.out[self.fail[child]]
+
+    def search(self, string):
+        goto, fail, out = self.goto, self.fail, self.out
+        if out[0] is not None:
+            #the empty string was one of the literals
+            return out[0]
+        node = 0
+        for char in string:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node] is not None:
+                return out[node]
+        return None
+
+
+class RegexList(object):
+    '''search() with each of a list of compiled regexes in turn, returning the first match or None'''
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    def search(self, string):
+        for cpat in self.compiled:
+            match = cpat.search(string)
+            if match is not None:
+                return match
+        return None
+
+
+_regexSpecialChars = set('.^$*+?{}[]\\|()')
+#inline flags apply to the whole of a regex, and group numbers shift when regexes are combined, so 
+#patterns with flags, backreferences or conditionals on group numbers can't be combined.  This 
+#sometimes catches escaped characters too, which only means using a RegexList unnecessarily
+_uncombinablePattern = re.compile(r'\(\?[iLmsux]|\\[1-9]|\(\?\(\d')
+
+
+def compile_pattern_list(patterns):
+    '''Return an object with a search method that returns None unless at least one of the
+    patterns matches the string passed to it, which is much faster for long lists of patterns 
+    than searching with each one.  If none of the patterns contains regex special characters, 
+    an AhoCorasickMatcher is used, otherwise the patterns are combined into a single regex, unless
+    any has inline flags or refers to groups by number, in which case each is searched with in turn.
+    Raises ValueError naming the first pattern that won't compile.
+    >>> compile_pattern_list(['FGT1690', 'FGT1691']).search('ObartAA03S_FGT1691') is not None
+    True
+    >>> compile_pattern_list(['FGT169[01]$', 'LOC_Os03g.*']).search('ObartAA03S_FGT1692') is not None
+    False
+    >>> compile_pattern_list(['(?i)abc', 'XYZ']).search('xyz') is not None
+    False
+    >>> [ compile_pattern_list(['(a)\\\\1', '(b)\\\\1']).search(string) is not None for string in ('bb', 'ba') ]
+    [True, False]
+    '''
+    if not any(_regexSpecialChars.intersection(pat) for pat in patterns):
+        return AhoCorasickMatcher(patterns)
+    compiled = []
+    for pat in patterns:
+        try:
+            compiled.append(re.compile(pat))
+        except re.error:
+            raise ValueError('problem compiling regex pattern %s' % pat)
+    if any(_uncombinablePattern.search(pat) for pat in patterns):
+        return RegexList(compiled)
+    try:
+        return re.compile('|'.join('(?:%s)' % pat for pat in patterns))
+    except (re.error, AssertionError, OverflowError):
+        #e.g. too many capture groups to combine them
+        return RegexList(compiled)
+
+
 def proportion_type(string):
     '''This is used for type and bound checking, specified as a type= argument in argparse.add_argument().
     It would be nice to be able to pass as specific range besides 0.0-1.0, but funcs used for type= can 
@@ -143,96 +257,393 @@ class BarebonesArgumentParser(ArgumentParser):
                                 help='file to write output to (default stdout)')
 
 
-def read_from_file_or_pickle(filename, pickleName, readFunc, *readFuncArgs, **readFuncKwargs):
+PARSE_CACHE_VERSION = 1
+#returned by ParseCache.load when nothing is cached
+CACHE_MISS = object()
+
+
+def default_parse_cache_dir():
+    '''Directory used for cached parses when none is specified.  Can be set with the
+    DZ_PARSE_CACHE_DIR environment variable, otherwise ~/.cache/dzparse'''
+    return path.expanduser(environ.get('DZ_PARSE_CACHE_DIR', path.join('~', '.cache', 'dzparse')))
+
+
+def _stable_repr(obj):
+    '''repr with any memory addresses stripped out, so that objects with default reprs
+    give the same string across runs'''
+    return re.sub(' at 0x[0-9a-fA-F]+', '', repr(obj))
+
+
+def _function_identity(func):
+    '''Identify a parsing function by module, name, version of the package it came from 
+    and, if it is a plain python function, a digest of its bytecode.  If any of these
+    change the parse cached with the old function won't be used.'''
+    module = getattr(func, '__module__', None) or ''
+    name = getattr(func, '__name__', None) or _stable_repr(func)
+    package = sys.modules.get(module.split('.')[0])
+    version = getattr(package, '__version__', None)
+    code = getattr(func, 'func_code', None)
+    codeDigest = hashlib.sha1(code.co_code + _stable_repr(code.co_consts)).hexdigest() if code else None
+    return (module, name, version, codeDigest)
+
+
+class ParseCache(object):
+    '''Cache of parsed files, stored as pickles in a single directory.
+    Entries are keyed on the identity of the source file (either a content hash, or 
+    path+size+mtime+inode), the parsing function and its arguments, so different callers
+    parsing the same file the same way share a cache entry, and changing any of those 
+    gives a new one.  Writes are atomic (temp file then rename), and once the cache 
+    grows past max_bytes the least recently used entries are removed.
+
+    There are two kinds of entries:
+    <key>.pickle - a single pickled object
+    <key>.stream - a series of records, each pickled separately and preceded by its 
+        length as an 8 byte unsigned int.  These can be read back one record at a time.
+    '''
+    suffixes = ('.pickle', '.stream')
+
+    def __init__(self, cacheDir=None, maxBytes=None):
+        self.cache_dir = default_parse_cache_dir() if cacheDir is None else path.expanduser(cacheDir)
+        if maxBytes is None:
+            maxBytes = int(environ.get('DZ_PARSE_CACHE_MAX_BYTES', 4 * 1024 ** 3))
+        self.max_bytes = maxBytes
+        if not path.isdir(self.cache_dir):
+            try:
+                makedirs(self.cache_dir)
+            except OSError:
+                #another process may have just made it
+                if not path.isdir(self.cache_dir):
+                    raise
+
+    def source_signature(self, filename, contentHash=False):
+        if contentHash:
+            sha = hashlib.sha1()
+            with open(filename, 'rb') as fileIn:
+                for block in iter(lambda: fileIn.read(1 << 20), ''):
+                    sha.update(block)
+            return ('sha1', sha.hexdigest())
+        st = stat(filename)
+        return ('stat', path.realpath(filename), st.st_size, st.st_mtime, st.st_ino)
+
+    def key(self, filename, readFunc, readFuncArgs=(), readFuncKwargs=None, contentHash=False):
+        if readFuncKwargs is None:
+            readFuncKwargs = {}
+        parts = (PARSE_CACHE_VERSION, self.source_signature(filename, contentHash), _function_identity(readFunc), 
+                [ _stable_repr(arg) for arg in readFuncArgs ], 
+                [ (k, _stable_repr(v)) for k, v in sorted(readFuncKwargs.iteritems()) ])
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def entry_path(self, key, suffix='.pickle'):
+        return path.join(self.cache_dir, key + suffix)
+
+    def load(self, key):
+        '''Return the cached object for key, or CACHE_MISS if there isn't one'''
+        entry = self.entry_path(key)
+        try:
+            pickleIn = open(entry, 'rb')
+        except IOError:
+            return CACHE_MISS
+        with pickleIn:
+            sys.stderr.write('reading cached parse %s... ' % entry)
+            try:
+                parsed = cPickle.load(pickleIn)
+            except (EOFError, cPickle.UnpicklingError):
+                sys.stderr.write('corrupt, removing\n')
+                self.remove(entry)
+                return CACHE_MISS
+            sys.stderr.write('done\n')
+        self.touch(entry)
+        return parsed
+
+    def load_stream(self, key):
+        '''Return an iterator over the records in a streamed entry for key, or CACHE_MISS if 
+        there isn't one.  Records are unpickled as they are iterated over.'''
+        entry = self.entry_path(key, '.stream')
+        try:
+            streamIn = open(entry, 'rb')
+        except IOError:
+            return CACHE_MISS
+        sys.stderr.write('streaming cached parse %s\n' % entry)
+        self.touch(entry)
+        return self._replay_stream(streamIn, entry)
+
+    def _replay_stream(self, streamIn, entry):
+        with streamIn:
+            while True:
+                header = streamIn.read(8)
+                if not header:
+                    break
+                if len(header) != 8:
+                    raise IOError('truncated cache entry %s' % entry)
+                size = struct.unpack('<Q', header)[0]
+                yield cPickle.loads(streamIn.read(size))
+
+    def store_stream(self, key, records):
+        '''Generator that passes along the passed records, writing each to a streamed entry 
+        for key as it goes.  The entry only appears in the cache once the records are 
+        exhausted, so if the caller stops iterating early nothing is cached.'''
+        streamOut, tempName, entry = self.open_for_writing(key, '.stream')
+        sys.stderr.write('writing cached parse %s as records are read\n' % entry)
+        completed = False
+        try:
+            for rec in records:
+                data = cPickle.dumps(rec, cPickle.HIGHEST_PROTOCOL)
+                streamOut.write(struct.pack('<Q', len(data)))
+                streamOut.write(data)
+                yield rec
+            completed = True
+        finally:
+            streamOut.close()
+            if completed:
+                self.commit(tempName, entry)
+            else:
+                self.remove(tempName)
+
+    def open_for_writing(self, key, suffix='.pickle'):
+        '''Return an open temp file in the cache directory and the name it should be given
+        by commit once it is completely written'''
+        fd, tempName = tempfile.mkstemp(dir=self.cache_dir, prefix='.' + key, suffix='.tmp')
+        return fdopen(fd, 'wb'), tempName, self.entry_path(key, suffix)
+
+    def commit(self, tempName, entry):
+        #rename is atomic, so readers either see the whole entry or nothing
+        rename(tempName, entry)
+        self.evict()
+
+    def store(self, key, parsed):
+        pickleOut, tempName, entry = self.open_for_writing(key)
+        sys.stderr.write('writing cached parse %s... ' % entry)
+        try:
+            with pickleOut:
+                cPickle.dump(parsed, pickleOut, cPickle.HIGHEST_PROTOCOL)
+        except:
+            self.remove(tempName)
+            raise
+        self.commit(tempName, entry)
+        sys.stderr.write('done\n')
+
+    def touch(self, entry):
+        '''mtime of an entry is used as its last use time for eviction'''
+        try:
+            utime(entry, None)
+        except OSError:
+            pass
+
+    def remove(self, entry):
+        try:
+            unlink(entry)
+        except OSError:
+            pass
+
+    def entries(self):
+        '''list of (last use time, size, path) for every entry in the cache'''
+        found = []
+        for name in listdir(self.cache_dir):
+            if name.endswith(self.suffixes):
+                full = path.join(self.cache_dir, name)
+                try:
+                    st = stat(full)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, full))
+        return found
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is under max_bytes.
+        The most recent entry is always kept, even if it is larger than max_bytes.'''
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, entry in entries)
+        for mtime, size, entry in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            sys.stderr.write('evicting cached parse %s\n' % entry)
+            self.remove(entry)
+            total -= size
+
+
+_defaultParseCache = None
+
+
+def get_default_parse_cache():
+    global _defaultParseCache
+    if _defaultParseCache is None:
+        _defaultParseCache = ParseCache()
+    return _defaultParseCache
+
+
+def read_from_file_or_cache(filename, readFunc, readFuncArgs=(), readFuncKwargs=None, cache=None, contentHash=False, stream=False):
     '''This takes a filename, and a function that would be used to parse that file, as well as arguments for
-    that parsing function.  If there is a file with the name <filename>.pickle that is more recent than 
-    <filename>, it will be unpickled into an object and returned.  Otherwise the parsing function will be 
-    called on the file, and the result pickled and returned.
-
-    The unsatisfying thing is that some parsing functions may return a generator rather than a list, dict or
-    other object.  Generators are not pickle-able, so this causes a problem.  Currently if the object returned
-    from the parse is a generator, cast it as a list before pickling it.  For many cases this will be fine for 
-    client code, but it obviously will not be ideal if the caller doesn't want the whole list in memory.
-    This is currently the caller's responsibility, and if they want a generator, don't use this function.  
-    For many cases this will be fine for client code, but it obviously will not be ideal if the caller 
-    doesn't want the whole list in memory.
-    NOTE: This is currently the caller's responsibility, and if they want a generator, don't use this function.
+    that parsing function.  If a parse of the file by that function with those arguments is in the cache
+    (a ParseCache, by default the one in default_parse_cache_dir()) it is returned, otherwise the file is 
+    parsed and the result cached.
+
+    By default a cached parse is considered fresh if the file has the same path, size, mtime and inode as
+    when it was parsed.  With contentHash=True the file contents are hashed instead, which is slower but 
+    survives copying or touching the file.
+
+    If the parse function returns a generator it is cast to a list before caching, unless stream=True.
+    In that case an iterator over the parsed records is returned instead.  If nothing is cached yet 
+    the records are cached one at a time as the caller iterates over them, and if something is cached 
+    the records are unpickled one at a time, so the full parse is never in memory at once.
     '''
-    if path.exists(filename):
-        sourceTime = stat(filename).st_mtime
-    else:
+    if not path.exists(filename):
         raise IOError("file %s doesn't exist?" % filename)
-    
-    #pickleName = filename + ".pickle"
-    pickleOK = False
-    if path.exists(pickleName):
-        pickleTime = stat(pickleName).st_mtime
-        if sourceTime <= pickleTime:
-            pickleOK = True
-        else:
-            sys.stderr.write('pickle file %s is too old, rewriting\n')
+    if readFuncKwargs is None:
+        readFuncKwargs = {}
+    if cache is None:
+        cache = get_default_parse_cache()
+
+    key = cache.key(filename, readFunc, readFuncArgs, readFuncKwargs, contentHash=contentHash)
+    if stream:
+        records = cache.load_stream(key)
+        if records is CACHE_MISS:
+            parsed = cache.load(key)
+            if parsed is not CACHE_MISS:
+                return iter(parsed)
+            records = cache.store_stream(key, readFunc(filename, *readFuncArgs, **readFuncKwargs))
+        return records
+
+    parsed = cache.load(key)
+    if parsed is CACHE_MISS:
+        records = cache.load_stream(key)
+        if records is not CACHE_MISS:
+            return list(records)
+        parsed = readFunc(filename, *readFuncArgs, **readFuncKwargs)
+        if inspect.isgenerator(parsed):
+            parsed = list(parsed)
+        cache.store(key, parsed)
+    return parsed
 
-    if pickleOK:
-        with open(pickleName, 'rb') as pickleIn:
-            sys.stderr.write('reading pickle file %s... ' % pickleName)
-            parsed = cPickle.load(pickleIn)
-            sys.stderr.write('done\n')
+
+def read_from_file_or_pickle(filename, pickleName, readFunc, *readFuncArgs, **readFuncKwargs):
+    '''Older interface to read_from_file_or_cache, using the default cache.  pickleName used to be 
+    the name of a pickle written next to the file, but parses are now cached in one directory 
+    keyed on the file and parse function, so it is ignored.  It is only kept so that existing 
+    callers don't break.
+    '''
+    return read_from_file_or_cache(filename, readFunc, readFuncArgs, readFuncKwargs)
+
+
+_nexusUnsafeChars = set(' \t\n()[]{}/\\,;:=*\'"`+-<>')
+
+
+def nexus_safe_name(name):
+    '''quote a taxon name for writing to a nexus file if necessary, as Bio.Nexus does
+    >>> nexus_safe_name('Oryza_sativa')
+    'Oryza_sativa'
+    >>> nexus_safe_name("O. sativa's")
+    "'O. sativa''s'"
+    '''
+    safe = name.replace("'", "''")
+    if _nexusUnsafeChars.intersection(safe):
+        safe = "'" + safe + "'"
+    return safe
+
+
+#a quoted name (with '' for a quote within it), a comment bracket, the end of the matrix or a plain word
+_nexusTokenRegex = re.compile(r"'(?:[^']|'')*'|[\[\];]|[^\s\[\]';]+|'")
+
+
+def _tokenize_nexus_line(line, commentDepth):
+    '''split a line of a nexus matrix into tokens, dropping comments (which can span lines, so the
+    depth of comment nesting is passed in and returned) and removing quotes from quoted names.
+    Returns (tokens, comment depth at end of line, index of a ; ending the matrix or -1)'''
+    tokens = []
+    for match in _nexusTokenRegex.finditer(line):
+        tok = match.group()
+        if tok == '[':
+            commentDepth += 1
+        elif tok == ']':
+            commentDepth = max(0, commentDepth - 1)
+        elif commentDepth:
+            continue
+        elif tok == ';':
+            return tokens, commentDepth, match.start()
+        elif tok[0] == "'" and len(tok) > 1:
+            tokens.append(tok[1:-1].replace("''", "'"))
+        else:
+            tokens.append(tok)
+    return tokens, commentDepth, -1
+
+
+def iterate_nexus_matrix_rows(nexusLines, beginningLines=None, endLines=None):
+    '''Generator of (taxon name, sequence) for each row of the matrix in nexus formatted lines, in a 
+    single pass with no buffering.  Quoted names and comments (including ones spanning lines) are 
+    handled, and sequences split by whitespace or comments are joined.  In an interleaved matrix 
+    each taxon comes up once per block (see read_nexus_matrix).  Lines before the matrix (including
+    the matrix line) and from the end of the matrix on are appended to beginningLines and endLines 
+    as they are read if they are passed, which can be anything with an append method.  endLines 
+    starts with the ; ending the matrix, without any row that is on the same line.
+    >>> lines = ['#NEXUS', 'begin data;', 'matrix', "'O. sativa' ACGT [a comment", 'more comment]', 
+    ...     'Obart AC-T', ';', 'end;']
+    >>> list(iterate_nexus_matrix_rows(lines))
+    [('O. sativa', 'ACGT'), ('Obart', 'AC-T')]
+    >>> list(iterate_nexus_matrix_rows(['matrix', 'O.glab AA ACGT', 'O. sativa AA AC-T', ';']))
+    [('O.glab AA', 'ACGT'), ('O. sativa AA', 'AC-T')]
+    >>> endLines = []
+    >>> list(iterate_nexus_matrix_rows(['matrix', 'tax1 AA', 'tax2 TT;', 'end;'], endLines=endLines)), endLines
+    ([('tax1', 'AA'), ('tax2', 'TT')], [';', 'end;'])
+    '''
+    lines = iter(nexusLines)
+    for line in lines:
+        if beginningLines is not None:
+            beginningLines.append(line)
+        if line.strip()[:6].lower() == 'matrix':
+            break
     else:
-        with open(filename, 'rb') as fileIn:
-            parsed = readFunc(filename, *readFuncArgs, **readFuncKwargs)
-            import inspect
-            if inspect.isgenerator(parsed):
-                parsed = list(parsed)
-        with open(pickleName, 'wb') as pickleOut:
-            sys.stderr.write('writing pickle file %s... ' % pickleName)
-            import inspect
-            if inspect.isgenerator(parsed):
-                parsed = list(parsed)
-            cPickle.dump(parsed, pickleOut, cPickle.HIGHEST_PROTOCOL)
-            sys.stderr.write('done\n')
-    return parsed
+        return
+
+    commentDepth = 0
+    for line in lines:
+        if not commentDepth and "'" not in line and '[' not in line and ']' not in line:
+            #the usual case, and much faster than tokenizing
+            semi = line.find(';')
+            tokens = (line if semi == -1 else line[:semi]).split()
+        else:
+            tokens, commentDepth, semi = _tokenize_nexus_line(line, commentDepth)
+        if tokens:
+            if len(tokens) == 1:
+                sys.exit("problem parsing line %s" % line)
+            #some old files have unquoted names with spaces, like O. sativa AA or O.glab AA
+            if len(tokens) > 2 and re.match('[OL][.]', tokens[0]):
+                yield ' '.join(tokens[:-1]), tokens[-1]
+            else:
+                yield tokens[0], ''.join(tokens[1:])
+        if semi != -1:
+            if endLines is not None:
+                #the last row can be on the same line as the ;, and is already yielded
+                endLines.append(line[semi:])
+                for line in lines:
+                    endLines.append(line)
+            return
+
+
+def read_nexus_matrix(nexusLines, taxToSequenceDict=None, beginningLines=None, endLines=None, asBytearray=False):
+    '''Read the matrix from nexus formatted lines into taxToSequenceDict (a new OrderedDict, in matrix order,
+    if it isn't passed), which is returned.  Interleaved blocks are joined.  Sequences are strings, or 
+    bytearrays if asBytearray, which can be used directly as numpy arrays with np.frombuffer.
+    See iterate_nexus_matrix_rows for beginningLines and endLines.
+    >>> lines = ['matrix', 'tax1 ACGT', 'tax2 AC-T', '', 'tax1 GG', 'tax2 TT;']
+    >>> read_nexus_matrix(lines).items()
+    [('tax1', 'ACGTGG'), ('tax2', 'AC-TTT')]
+    '''
+    chunks = OrderedDict()
+    for name, seq in iterate_nexus_matrix_rows(nexusLines, beginningLines, endLines):
+        chunks.setdefault(name, []).append(seq)
+    if taxToSequenceDict is None:
+        taxToSequenceDict = OrderedDict()
+    for name, seqChunks in chunks.iteritems():
+        seq = seqChunks[0] if len(seqChunks) == 1 else ''.join(seqChunks)
+        taxToSequenceDict[name] = bytearray(seq) if asBytearray else seq
+    return taxToSequenceDict
 
 
 def extract_sequences_and_stuff_from_nexus_file(nfile, taxToSequenceDict, beginningLinesInNexus=None, endLinesInNexus=None):
     '''this just gets some random stuff that I extract from a nexus file that I was using in a few different scripts
     this includes a dictionary of taxon names to sequences, the lines in the file before the matrix, and the lines
-    in the file after the matrix'''
-    foundSequences = False
-    finishedSequences = False
+    in the file after the matrix.  See read_nexus_matrix'''
     with open(nfile, 'rb') as nexusFile:
-        for line in nexusFile:
-            #get the sequence lines in the nexus file
-            
-            if 'matrix' in line.lower() and not foundSequences:
-                foundSequences = True
-                if beginningLinesInNexus:
-                    beginningLinesInNexus.append(line)
-
-            elif foundSequences and not finishedSequences:
-                #this is assuming that the matrix ends with a line containing only a semicolon and whitespace
-                if re.search('^;', line.strip()):
-                    finishedSequences = True
-                    if endLinesInNexus:
-                        endLinesInNexus.append(line)
-                else:
-                    stuff = line.split()
-                    #taxon name that starts each matrix line can either be quoted or underscored to escape the spaces
-                    if re.search('^[\']', line) or re.search('^[OL][.]', line):
-                        #want to go from 
-                        #'Oryza blah AA' ACGT... to [ 'Oryza blah AA', 'ACGT...' ]
-                        #this looks like an ugly way to do this, but is much faster than using shlex as I used to
-                        #stuff = shlex.split(line)
-                        stuff = [ re.sub('\'', '', ' '.join(stuff[:-1])), stuff[-1] ]
-
-                    if len(stuff) != 2:
-                        sys.exit("problem parsing line %s" % line)
-                    taxToSequenceDict[stuff[0]] = stuff[1]
-            else:
-                #if endLinesInNexus and foundSequences:
-                if endLinesInNexus is not None and finishedSequences:
-                    endLinesInNexus.append(line)
-                if beginningLinesInNexus is not None and not foundSequences:
-                    beginningLinesInNexus.append(line)
+        read_nexus_matrix(nexusFile, taxToSequenceDict, beginningLinesInNexus, endLinesInNexus)
  
 
 class CoordinateSet(object):
@@ -428,19 +839,247 @@ def my_dag_sort(first, sec):
             return False
 
 
-def parse_daglines(infile, self_hits=False):
+class DagLineView(DagLine):
+    '''A row of a DagLineStore, which behaves like a DagLine (including hashing, equality and ordering)
+    but holds only the store and row number, with the fields made from the store when needed.'''
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def fields(self):
+        return self.store.fields(self.row)
+
+    @property
+    def string(self):
+        return '\t'.join(self.fields)
+
+    @property
+    def cut_string(self):
+        return '\t'.join(self.fields[:-1])
+
+    @property
+    def tax1(self):
+        return self.store.names[self.store.gene1[self.row]]
+
+    @property
+    def tax2(self):
+        return self.store.names[self.store.gene2[self.row]]
+
+    @property
+    def evalue(self):
+        return self.store.evalue_strings[self.store.evalue_codes[self.row]]
+
+
+class DagLineStore(object):
+    '''Columnar storage of dagchainer lines, for when there are far too many to have a DagLine (with 
+    three copies of the line) for each.  Chromosome and gene names are interned and stored as integer 
+    codes, coordinates as integers and e-values as floats, all in arrays.  The text of each distinct 
+    e-value is also kept, since it can be written multiple ways.  Indexing or iterating gives 
+    DagLineViews, which act like DagLines.
+    >>> store = DagLineStore(['rufipogon_3s OrufiAA03S_FGT1690 1735 1735 glaberrima_3s OglabAA03S_FGT1985 1972 1972 1e-199',
+    ...     'rufipogon_3s OrufiAA03S_FGT1690 1735 1735 barthii_3s ObartAA03S_FGT0001 1 1 1.0e-199'])
+    >>> len(store), store[1].tax2, store[1].evalue, store.evalues[1]
+    (2, 'ObartAA03S_FGT0001', '1.0e-199', 1e-199)
+    >>> store[0] == DagLine(str(store[0])), store[1] < store[0]
+    (True, True)
+    '''
+    def __init__(self, lines=None):
+        self.names = []
+        self.name_codes = {}
+        self.evalue_strings = []
+        self.evalue_string_codes = {}
+        self.chrom1, self.gene1, self.chrom2, self.gene2 = array('i'), array('i'), array('i'), array('i')
+        self.start1, self.end1, self.start2, self.end2 = array('l'), array('l'), array('l'), array('l')
+        self.evalue_codes = array('i')
+        self.evalues = array('d')
+        if lines is not None:
+            for line in lines:
+                self.append(line)
+
+    def _code(self, name):
+        code = self.name_codes.get(name)
+        if code is None:
+            code = self.name_codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def append(self, line):
+        '''add a line, either a string or already split into (9) fields'''
+        fields = line.split() if isinstance(line, str) else line
+        if len(fields) != 9:
+            raise ValueError('Wrong number of fields in dag string')
+        try:
+            coords = [ int(fields[num]) for num in (2, 3, 6, 7) ]
+            evalue = float(fields[8])
+        except ValueError:
+            raise ValueError('bad coordinate or evalue in dag string %s' % '\t'.join(fields))
+        self.chrom1.append(self._code(fields[0]))
+        self.gene1.append(self._code(fields[1]))
+        self.chrom2.append(self._code(fields[4]))
+        self.gene2.append(self._code(fields[5]))
+        self.start1.append(coords[0])
+        self.end1.append(coords[1])
+        self.start2.append(coords[2])
+        self.end2.append(coords[3])
+        evalueCode = self.evalue_string_codes.get(fields[8])
+        if evalueCode is None:
+            evalueCode = self.evalue_string_codes[fields[8]] = len(self.evalue_strings)
+            self.evalue_strings.append(fields[8])
+        self.evalue_codes.append(evalueCode)
+        self.evalues.append(evalue)
+
+    def fields(self, row):
+        names = self.names
+        return [ names[self.chrom1[row]], names[self.gene1[row]], str(self.start1[row]), str(self.end1[row]), 
+                names[self.chrom2[row]], names[self.gene2[row]], str(self.start2[row]), str(self.end2[row]), 
+                self.evalue_strings[self.evalue_codes[row]] ]
+
+    def __len__(self):
+        return len(self.gene1)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('dagline index out of range')
+        return DagLineView(self, row)
+
+    def __iter__(self):
+        for row in xrange(len(self)):
+            yield DagLineView(self, row)
+
+    def sort(self):
+        '''reorder the rows by their fields, as parse_daglines sorts lines, except that coordinates are 
+        compared as numbers rather than text'''
+        #names are compared by their rank, so that the sort keys are just integers
+        nameRanks = [0] * len(self.names)
+        for rank, code in enumerate(sorted(xrange(len(self.names)), key=self.names.__getitem__)):
+            nameRanks[code] = rank
+        evalueRanks = [0] * len(self.evalue_strings)
+        for rank, code in enumerate(sorted(xrange(len(self.evalue_strings)), key=self.evalue_strings.__getitem__)):
+            evalueRanks[code] = rank
+        #rather than a tuple key for every row, which would take far more memory than the columns, 
+        #consecutive columns are packed into single integer keys as long as their ranges of values fit in 
+        #an array item, and then there is a stable sort on each packed key in turn from the least significant, 
+        #as numpy's lexsort does.  Each pass only has one integer per row, looked up from an array without 
+        #a python function call
+        columns = []
+        for attr, ranks in (('chrom1', nameRanks), ('gene1', nameRanks), ('start1', None), ('end1', None), 
+                ('chrom2', nameRanks), ('gene2', nameRanks), ('start2', None), ('end2', None), ('evalue_codes', evalueRanks)):
+            column = getattr(self, attr)
+            if ranks is not None:
+                column = array('i', (ranks[code] for code in column))
+            columns.append(column)
+        keyLimit = 2 ** (8 * array('l').itemsize - 2)
+        packedKeys = []
+        group, groupRange = [], 1
+        for column in columns:
+            low, high = (min(column), max(column)) if len(column) else (0, 0)
+            if group and groupRange * (high - low + 1) >= keyLimit:
+                packedKeys.append(self._packed_key(group))
+                group, groupRange = [], 1
+            group.append((column, low, high - low + 1))
+            groupRange *= high - low + 1
+        packedKeys.append(self._packed_key(group))
+        order = range(len(self))
+        for key in reversed(packedKeys):
+            order.sort(key=key.__getitem__)
+        for attr in ('chrom1', 'gene1', 'chrom2', 'gene2', 'start1', 'end1', 'start2', 'end2', 'evalue_codes', 'evalues'):
+            column = getattr(self, attr)
+            setattr(self, attr, array(column.typecode, (column[row] for row in order)))
+
+    @staticmethod
+    def _packed_key(group):
+        '''array of one integer per row ordering rows in the same way as the (column, lowest value, number 
+        of values) columns in group, most significant first'''
+        if len(group) == 1:
+            return group[0][0]
+        key = array('l', [0]) * len(group[0][0])
+        for column, low, size in group:
+            key = array('l', (packed * size + value - low for packed, value in izip(key, column)))
+        return key
+
+
+def iterate_daglines(infile, self_hits=False, maxEvalue=None, taxonPairs=None):
+    '''Generator of the fields of dagchainer lines from a filename or open file, filtered as they are 
+    read.  Comment lines are skipped, as are hits of a gene to itself unless self_hits, hits with 
+    evalues above maxEvalue if it is passed, and if taxonPairs (pairs of taxon names, i.e. the first 7 
+    characters of gene names, in either order) is passed, hits between taxa that aren't one of the pairs.
+    >>> lines = ['#a comment', 
+    ...     'r_3s OrufiAA03S_FGT1690 1 1 g_3s OglabAA03S_FGT1985 1 1 1e-199',
+    ...     'r_3s OrufiAA03S_FGT1690 1 1 r_3s OrufiAA03S_FGT1690 1 1 0.0',
+    ...     'r_3s OrufiAA03S_FGT1690 1 1 b_3s ObartAA03S_FGT0001 1 1 1e-5']
+    >>> [ fields[5] for fields in iterate_daglines(lines, maxEvalue=1e-10) ]
+    ['OglabAA03S_FGT1985']
+    >>> [ fields[5] for fields in iterate_daglines(lines, taxonPairs=[('ObartAA', 'OrufiAA')]) ]
+    ['ObartAA03S_FGT0001']
+    '''
     if isinstance(infile, str):
-        hand = open(infile, 'r')
-    else:
-        hand = infile
+        infile = open(infile, 'r')
+    if taxonPairs is not None:
+        taxonPairs = set(frozenset(pair) for pair in taxonPairs)
+    for line in infile:
+        if '#' in line:
+            continue
+        fields = line.split()
+        if not fields:
+            continue
+        if not self_hits and fields[1] == fields[5]:
+            continue
+        if maxEvalue is not None and float(fields[8]) > maxEvalue:
+            continue
+        if taxonPairs is not None and frozenset((fields[1][:7], fields[5][:7])) not in taxonPairs:
+            continue
+        yield fields
 
-    lines = [ line.split() for line in hand if not '#' in line ]
-    lines.sort()
-    if self_hits:
-        dagLines = [ DagLine(line) for line in lines ]
-    else:
-        dagLines = [ DagLine(line) for line in lines if line[1] != line[5] ]
-    return dagLines
+
+def sort_daglines_external(fieldLists, maxLinesInMemory=1000000, tempDir=None):
+    '''Generator of the passed lists of dagchainer fields in sorted order (as parse_daglines sorts them),
+    holding no more than maxLinesInMemory of them at a time.  Sorted runs of that many lines are written 
+    to temporary files, which are then merged.
+    >>> lines = iterate_daglines(['c %s 1 1 c %s 1 1 0.0' % pair for pair in [('b', 'a'), ('a', 'c'), ('b', 'c'), ('a', 'b')]])
+    >>> [ fields[1] + fields[5] for fields in sort_daglines_external(lines, maxLinesInMemory=3) ]
+    ['ab', 'ac', 'ba', 'bc']
+    '''
+    runs = []
+    chunk = []
+    for fields in fieldLists:
+        chunk.append(fields)
+        if len(chunk) >= maxLinesInMemory:
+            chunk.sort()
+            run = tempfile.TemporaryFile(dir=tempDir)
+            run.writelines('\t'.join(fields) + '\n' for fields in chunk)
+            run.seek(0)
+            runs.append(run)
+            chunk = []
+    chunk.sort()
+    if not runs:
+        for fields in chunk:
+            yield fields
+        return
+    #fields are tab joined in the runs, so they can be split back into identical lists
+    try:
+        for fields in heapq.merge(chunk, *[ (line.rstrip('\n').split('\t') for line in run) for run in runs ]):
+            yield fields
+    finally:
+        for run in runs:
+            run.close()
+
+
+def parse_daglines(infile, self_hits=False, compact=False, maxEvalue=None, taxonPairs=None):
+    '''Read dagchainer output, returning a sorted list of DagLines, or if compact a sorted DagLineStore, 
+    which can be indexed and iterated in the same way, but uses a fraction of the memory.
+    Lines are filtered as they are read, see iterate_daglines.'''
+    lines = iterate_daglines(infile, self_hits=self_hits, maxEvalue=maxEvalue, taxonPairs=taxonPairs)
+
+    if compact:
+        #lines are never all held as text or lists of fields
+        store = DagLineStore(lines)
+        store.sort()
+        return store
+
+    return [ DagLine(line) for line in sorted(lines) ]
 
 
 class BlinkCluster(object):
@@ -472,9 +1111,9 @@ class BlinkCluster(object):
         else:
             self.noDupes = True
 
+        #daglineDoubleDict can also be a DaglineIndex, which is much faster when making many clusters
         if dagLines is not None and len(dagLines):
-            #daglineDoubleDict = get_dagline_double_dict(dagLines)
-            daglineDoubleDict = get_dagline_double_dict_from_dagline_objects(dagLines)
+            daglineDoubleDict = DaglineIndex(dagLines)
         else:
             self.dag_lines = []
             self.dag_line_set = set()
@@ -495,6 +1134,7 @@ class BlinkCluster(object):
 
     def add(self, member):
         self.cluster_members.append(member)
+        self.member_set.add(member)
     
     def __len__(self):
         return len(self.cluster_members)
@@ -529,12 +1169,7 @@ class BlinkCluster(object):
         return False
     
     def __contains__(self, name):
-        return name in self.cluster_members
-        '''
-        if name in self.cluster_members:
-            return True
-        return False
-        '''
+        return name in self.member_set
     
     def __iter__(self):
         return self
@@ -586,17 +1221,87 @@ class SetOfClusters(object):
         #list with one tuple per cluster, containing the cluster_members
         self.cluster_member_tuples = [ tuple(sorted(clust.cluster_members)) for clust in self.blink_clusters ]
         #dictionary to find clusters indexed by their tuples
-        clusterDict = {}
+        self.cluster_dict = {}
+        #dictionary of each member to the clusters containing it, in order
+        self.member_index = {}
         for tup, clust in izip(self.cluster_member_tuples, self.blink_clusters):
-            clusterDict[tup] = clust
+            self._index_cluster(tup, clust)
         #a single set, with clusters (as tuples) as members 
         self.cluster_tuple_set = set(self.cluster_member_tuples)
-    
+
+    def _index_cluster(self, tup, clust):
+        self.cluster_dict.setdefault(tup, clust)
+        for memb in tup:
+            self.member_index.setdefault(memb, []).append(clust)
+
+    def add_cluster(self, clust):
+        '''add a BlinkCluster, keeping the indexes up to date.  Clusters shouldn't have members
+        added or removed once they are in a SetOfClusters, or the indexes won't be.'''
+        tup = tuple(sorted(clust.cluster_members))
+        self.blink_clusters.append(clust)
+        self.cluster_set.add(clust)
+        self.cluster_member_tuples.append(tup)
+        self.cluster_tuple_set.add(tup)
+        self._index_cluster(tup, clust)
+
+    def remove_cluster(self, clust):
+        '''remove a BlinkCluster (this exact one, not just one with the same members), keeping the 
+        indexes up to date'''
+        for num, other in enumerate(self.blink_clusters):
+            if other is clust:
+                break
+        else:
+            raise ValueError('cluster %d not in SetOfClusters' % clust.number)
+        del self.blink_clusters[num]
+        tup = self.cluster_member_tuples.pop(num)
+        for memb in tup:
+            containing = [ other for other in self.member_index[memb] if other is not clust ]
+            if containing:
+                self.member_index[memb] = containing
+            else:
+                del self.member_index[memb]
+        #other clusters may have the same members
+        sameMembers = [ other for other, otherTup in izip(self.blink_clusters, self.cluster_member_tuples) if otherTup == tup ]
+        if sameMembers:
+            self.cluster_dict[tup] = sameMembers[0]
+        else:
+            del self.cluster_dict[tup]
+            self.cluster_tuple_set.discard(tup)
+            self.cluster_set.discard(clust)
+
     def get_cluster_by_member(self, memb):
-        for clust in self.blink_clusters:
-            if memb in clust:
-                return clust
-        return None
+        '''the first cluster containing memb, or None'''
+        containing = self.member_index.get(memb)
+        return containing[0] if containing else None
+
+    def get_clusters_by_member(self, memb):
+        '''list of all clusters containing memb'''
+        return list(self.member_index.get(memb, ()))
+
+    def get_clusters_by_members(self, members):
+        '''dict of each of members to the first cluster containing it, or None'''
+        return dict( (memb, self.get_cluster_by_member(memb)) for memb in members )
+
+    def get_clusters_containing_any(self, members):
+        '''list of the distinct clusters containing any of members, in the order first found'''
+        found = []
+        seen = set()
+        for memb in members:
+            for clust in self.member_index.get(memb, ()):
+                if id(clust) not in seen:
+                    seen.add(id(clust))
+                    found.append(clust)
+        return found
+
+    def get_cluster_by_members(self, members):
+        '''the cluster with exactly the members passed, or None'''
+        return self.cluster_dict.get(tuple(sorted(members)))
+
+    def __contains__(self, clust):
+        '''whether a cluster with the same members (a BlinkCluster or a sequence of members) is in the set'''
+        if isinstance(clust, BlinkCluster):
+            clust = clust.cluster_members
+        return tuple(sorted(clust)) in self.cluster_dict
 
     def cluster_union(self, other):
         union = self.cluster_set | other.cluster_set
@@ -630,61 +1335,15 @@ class SetOfClusters(object):
             string += '%s' % c
         return string
 
-    '''
     def get_clusters_that_are_subsets_and_supersets(self, other):
-        #first remove any identical clusters
-
-        intersect = SetOfClusters([BlinkCluster(-1, members=list(c)) for c in self.cluster_intersection(other)])
-        union = SetOfClusters([BlinkCluster(-1, members=list(c)) for c in self.cluster_union(other)])
-        reduced1 = SetOfClusters([BlinkCluster(-1, members=list(c)) for c in self.cluster_difference(other)])
-        reduced2 = SetOfClusters([BlinkCluster(-1, members=list(c)) for c in other.cluster_difference(self)])
-        
-        one = len(self)
-        two = len(other)
-        un = len(union)
-        inter = len(intersect)
-        only1 = len(reduced1)
-        only2 = len(reduced2)
-        print one, two, un, inter, only1, only2
-        print inter / float(one), inter / float(two)
-        exit()
-
-        #print len(reduced1)
-        #print len(reduced2)
-        n1 = 0
-        num = 0
-        for clust1 in reduced1:
-            n2 = 1
-            n1 +=1 
-            #print 'outer'
-            for clust2 in reduced2:
-                #print 'inner'
-                #print n1, n2
-                n2+=1
-                if len(clust1.member_intersection(clust2) > 0:
-                    if clust1.noDupes or clust2.noDupes:
-                        if len(clust1.member_difference(clust2)) != 0 and len(clust2.member_difference(clust1)) != 0:
-                            print 'not sub or super'
-                        elif len(clust1) > len(clust2):
-                            print 'subset'
-                        else:
-                            print 'superset'
-                        
-                        m1 = set(clust1)
-                        m2 = set(clust2)
-                        comb = sorted(list(m1 | m2))
-                        for memb in comb:
-                            if memb in clust1:
-                                print num, memb,
-                            else:
-                                print num, '-',
-                            if memb in clust2:
-                                print memb
-                            else:
-                                print '-'
-                        num += 1
+        '''list of (cluster here, cluster in other, relationship) for every pair of clusters where one is a 
+        strict subset of the other, relationship being 'subset' or 'superset' from the point of view of 
+        the cluster here.  See clusterutils.ClusteringComparison.'''
+        #clusterutils imports this module (and numpy)
+        from clusterutils import ClusteringComparison
+        return [ (clust1, clust2, relation) for clust1, clust2, shared, relation in ClusteringComparison(self, other).pairs() 
+                if relation in ('subset', 'superset') ]
 
-        '''
 
 def parse_mcl_output(filename):
     '''read MCL output, which looks like the below, return a list of BlinkClusters
@@ -714,6 +1373,7 @@ def parse_blink_output(filename, dagline_dict=None):
     2	OrufiAA03S_FGT0182
     2	OglabAA03S_FGT0266
     2	OminuCC03S_FGT0238
+    dagline_dict is passed on to each BlinkCluster as daglineDoubleDict, and is best a DaglineIndex
     '''
     lines = ( l.split() for l in open(filename, "rb") )
     allClusters = []
@@ -740,16 +1400,11 @@ def parse_blink_output(filename, dagline_dict=None):
         allClusters.append(BlinkCluster(c, clustDict[c], daglineDoubleDict=dagline_dict))
     return allClusters
 
-'''
 def blink_cluster_from_clique(thisClust, maxClique, mapping=None):
-    if mapping is not None:
-        new_members = []
-        for member in clique:
-            if mapping is not None:
-                new_members.append(mapping[member]
-            else:
-                new_members.append(member)
-'''
+    '''BlinkCluster numbered thisClust with the nodes of a clique as members, mapped to names with mapping
+    (anything indexable by node, e.g. a dict of dfmax node numbers to names) if it is passed'''
+    return BlinkCluster(thisClust, list(maxClique), mapping=mapping)
+
 '''
 def get_dagline_set_for_cluster(genes, daglineDoubleDict):
     clustHits = set()
@@ -768,71 +1423,160 @@ def get_dagline_set_for_cluster(genes, daglineDoubleDict):
     return clustHits
 '''
 
+def normalize_dag_gene_name(name):
+    '''remove any version suffix (.1 etc) from a gene name, as done to the names in dagchainer lines
+    when they are indexed
+    >>> normalize_dag_gene_name('LOC_Os03g01008.12'), normalize_dag_gene_name('OglabAA03S_FGT1985')
+    ('LOC_Os03g01008', 'OglabAA03S_FGT1985')
+    '''
+    head, dot, tail = name.rpartition('.')
+    if dot and (not tail or tail.isdigit()):
+        return head
+    return name
+
+
+def dag_gene_lookup_names(name):
+    '''names that a cluster member might be indexed under: the name itself and the name without 
+    a single digit version suffix'''
+    if len(name) > 1 and name[-2] == '.' and name[-1].isdigit():
+        return (name, name[:-2])
+    return (name, )
+
+
+def _dagline_for_cluster(dl):
+    return dl if isinstance(dl, DagLine) else '\t'.join(dl)
+
+
+class DaglineIndex(object):
+    '''Index of dagchainer hits (DagLines or lists of fields of lines) by the pair of genes involved, 
+    for pulling out all of the hits among the members of a cluster.  Does the same thing as 
+    get_dagline_double_dict, but the gene names are normalized (see normalize_dag_gene_name) only 
+    once as the index is built and are held as integer ids, and the query for a cluster of k genes 
+    takes time proportional to k plus the number of hits rather than k squared.
+    As in get_dagline_double_dict, if there are multiple lines for a pair of genes the last is kept.
+    >>> index = DaglineIndex([ DagLine(line) for line in [
+    ...     'r_3s OrufiAA03S_FGT1690 1 1 g_3s OglabAA03S_FGT1985.1 1 1 1e-199',
+    ...     'r_3s OrufiAA03S_FGT1690 1 1 b_3s ObartAA03S_FGT0001 1 1 1e-100',
+    ...     'g_3s OglabAA03S_FGT1985 1 1 b_3s ObartAA03S_FGT0001 1 1 1e-50' ] ])
+    >>> [ str(line).split()[-1] for line in index.hits_within(['OrufiAA03S_FGT1690', 'OglabAA03S_FGT1985.1']) ]
+    ['1e-199']
+    >>> len(index.hits_within(['OrufiAA03S_FGT1690', 'OglabAA03S_FGT1985', 'ObartAA03S_FGT0001']))
+    3
+    '''
+    def __init__(self, daglines=None):
+        self.gene_ids = {}
+        self.gene_names = []
+        #for each gene id, a dict of hit gene ids to lines
+        self.hits = []
+        self.num_lines = 0
+        if daglines is not None:
+            for line in daglines:
+                self.add(line)
+
+    def _gene_id(self, name):
+        geneId = self.gene_ids.get(name)
+        if geneId is None:
+            geneId = self.gene_ids[name] = len(self.gene_names)
+            self.gene_names.append(name)
+            self.hits.append({})
+        return geneId
+
+    def add(self, line):
+        if isinstance(line, DagLine):
+            t1, t2 = line.tax1, line.tax2
+        else:
+            t1, t2 = line[1], line[5]
+        hits = self.hits[self._gene_id(normalize_dag_gene_name(t1))]
+        t2Id = self._gene_id(normalize_dag_gene_name(t2))
+        if t2Id not in hits:
+            self.num_lines += 1
+        hits[t2Id] = line
+
+    def __len__(self):
+        return self.num_lines
+
+    def __contains__(self, name):
+        return name in self.gene_ids
+
+    def hits_within(self, genes):
+        '''List of the lines for hits from any member of genes to any other, for each member going through 
+        the other members in order (so the same list that get_dagline_list_for_cluster makes before sorting).  
+        Lines that are lists of fields are returned joined with tabs.'''
+        geneIds = self.gene_ids
+        #the ids each member can be found under, in order of preference
+        candidates = []
+        #positions of members and their preference for each id
+        positionsForId = {}
+        for pos, gene in enumerate(genes):
+            ids = []
+            for name in dag_gene_lookup_names(gene):
+                geneId = geneIds.get(name)
+                if geneId is not None and geneId not in ids:
+                    positionsForId.setdefault(geneId, []).append((pos, len(ids)))
+                    ids.append(geneId)
+            candidates.append(ids)
+
+        clustHits = []
+        for pos1, ids1 in enumerate(candidates):
+            for id1 in ids1:
+                subHits = self.hits[id1]
+                if len(subHits) < len(genes):
+                    #go through the hits of this gene, finding the best id for each member hit
+                    found = {}
+                    for id2, line in subHits.iteritems():
+                        for pos2, pref in positionsForId.get(id2, ()):
+                            if pos2 != pos1 and (pos2 not in found or pref < found[pos2][0]):
+                                found[pos2] = (pref, line)
+                    clustHits.extend(_dagline_for_cluster(found[pos2][1]) for pos2 in sorted(found))
+                else:
+                    for pos2, ids2 in enumerate(candidates):
+                        if pos2 != pos1:
+                            for id2 in ids2:
+                                if id2 in subHits:
+                                    clustHits.append(_dagline_for_cluster(subHits[id2]))
+                                    break
+        return clustHits
+
+
 def get_dagline_set_for_cluster(genes, daglineDoubleDict):
+    '''set of the dagchainer lines for hits between genes.  daglineDoubleDict is either a DaglineIndex 
+    (much faster) or from get_dagline_double_dict'''
+    if isinstance(daglineDoubleDict, DaglineIndex):
+        return set(daglineDoubleDict.hits_within(genes))
     clustHits = set()
-    for tax1 in range(0, len(genes)):
-        names1 = [genes[tax1], re.sub('[.][0-9]$', '', genes[tax1])]
-        #print 'names1', names1
+    lookupNames = [ dag_gene_lookup_names(gene) for gene in genes ]
+    for tax1, names1 in enumerate(lookupNames):
         for n1 in names1:
-            found = False
             if n1 in daglineDoubleDict:
-                #print '\tfound n1:', n1
                 sub_dict = daglineDoubleDict[n1]
-                for tax2 in range(0, len(genes)):
+                for tax2, names2 in enumerate(lookupNames):
                     if tax1 != tax2:
-                        names2 = [genes[tax2], re.sub('[.][0-9]$', '', genes[tax2])]
-                        #print '\tnames1', names1
                         for n2 in names2:
                             if n2 in sub_dict:
-                                #print '\t\tfound n2:', n2
-                                dl = sub_dict[n2]
-                                if isinstance(dl, DagLine):
-                                    clustHits.add(dl)
-                                else:
-                                    clustHits.add('\t'.join(dl))
-                                #found = True
+                                clustHits.add(_dagline_for_cluster(sub_dict[n2]))
                                 break
     return clustHits
 
 
 def get_dagline_list_for_cluster(genes, daglineDoubleDict):
-    #print 'dictsize', len(daglineDoubleDict)
-    #print daglineDoubleDict.keys()
-    clustHits = []
-    for tax1 in genes:
-        names1 = [tax1, re.sub('[.][0-9]$', '', tax1)]
-        #print 'names1', names1
-        for n1 in names1:
-            found = False
-            if n1 in daglineDoubleDict:
-                #print '\tfound n1:', n1
-                sub_dict = daglineDoubleDict[n1]
-                for tax2 in genes:
-                    if tax1 != tax2:
-                        names2 = [tax2, re.sub('[.][0-9]$', '', tax2)]
-                        #print '\tnames1', names1
-                        for n2 in names2:
-                            if n2 in sub_dict:
-                                #print '\t\tfound n2:', n2
-                                dl = sub_dict[n2]
-                                #if 'glab' in n1:
-                                #    print names1, names2
-                                if isinstance(dl, DagLine):
-                                    #if 'glab' in n1:
-                                    #    print dl
-                                    clustHits.append(dl)
-                                else:
-                                    clustHits.append('\t'.join(dl))
-                                #found = True
-                                break
+    '''sorted list of the dagchainer lines for hits between genes.  daglineDoubleDict is either a 
+    DaglineIndex (much faster) or from get_dagline_double_dict'''
+    if isinstance(daglineDoubleDict, DaglineIndex):
+        clustHits = daglineDoubleDict.hits_within(genes)
+    else:
+        clustHits = []
+        lookupNames = [ dag_gene_lookup_names(gene) for gene in genes ]
+        for tax1, names1 in enumerate(lookupNames):
+            for n1 in names1:
+                if n1 in daglineDoubleDict:
+                    sub_dict = daglineDoubleDict[n1]
+                    for tax2, names2 in enumerate(lookupNames):
+                        if tax1 != tax2:
+                            for n2 in names2:
+                                if n2 in sub_dict:
+                                    clustHits.append(_dagline_for_cluster(sub_dict[n2]))
+                                    break
     clustHits.sort()
-
-    '''
-    print 'added'
-    for line in clustHits:
-        if 'glab' in line.tax1:
-            print line
-    '''
     return clustHits
 
 
@@ -938,27 +1682,35 @@ class HitList(object):
     def __len__(self):
         return len(self.hitlist)
 
-    def get_sublist_by_query_names(self, names):
-        #subset = sets.Set()
+    def _get_sublist_by_fields(self, names, fields):
+        '''HitList of the hits with any of names in (as a substring of) any of the given fields of the hit.  
+        All of the names are searched for at once, and each distinct query or hit name is only searched once.'''
+        matcher = AhoCorasickMatcher(names)
+        matches = {}
         subset = set()
         for hit in self.hitlist:
-            for name in names:
-                if name in hit[0]:
+            for field in fields:
+                found = matches.get(hit[field])
+                if found is None:
+                    found = matches[hit[field]] = matcher.search(hit[field]) is not None
+                if found:
                     subset.add(hit)
-        #return subset
+                    break
         return HitList(subset)
+
+    def get_sublist_by_query_names(self, names):
+        return self._get_sublist_by_fields(names, (0,))
         
     def get_sublist_by_hit_names(self, names):
-        subset = set()
-        for hit in self.hitlist:
-            for name in names:
-                if name in hit[1]:
-                    subset.add(hit)
-        return HitList(subset)
+        return self._get_sublist_by_fields(names, (1,))
 
     def get_sublist_by_query_or_hit_names(self, names):
-        subset = self.get_sublist_by_query_names(names)
-        return subset.union(self.get_sublist_by_hit_names(names))
+        '''
+        >>> hits = HitList([('LOC_Os03g01008', 'OglabAA03S_FGT0268'), ('OglabAA03S_FGT0268', 'ObartAA03S_FGT0026'), ('ObartAA03S_FGT0026', 'ObartAA03S_FGT0027')])
+        >>> sorted(hits.get_sublist_by_query_or_hit_names(['LOC', 'FGT0268']).hitlist)
+        [('LOC_Os03g01008', 'OglabAA03S_FGT0268'), ('OglabAA03S_FGT0268', 'ObartAA03S_FGT0026')]
+        '''
+        return self._get_sublist_by_fields(names, (0, 1))
    
     def union(self, others):
         return HitList(self.hitlist.union(others.hitlist))
@@ -989,6 +1741,7 @@ class HitList(object):
         for hit in self.hitlist:
             #set.add((self.uniqueNames[hit[0]], self.uniqueNames[hit[1]]))
             numSet.add((self.uniqueNames[hit[0]], self.uniqueNames[hit[1]]))
+        return numSet
 
     def output_for_dfmax(self, stream=sys.stdout):
         if self.uniqueNames is None:
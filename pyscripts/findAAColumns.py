@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import sys
+from alignutils import CharacterMatrix, codon_range_for_column
 
-onlyCount = None
 if len(sys.argv) > 2:
     filename = sys.argv[1]
 else:
@@ -10,11 +10,10 @@ else:
 
 target = sys.argv[2]
 
+#output nucleotide charset ranges for the codons corresponding to each amino acid column
+#containing the target, in the sequence lines containing XXX (after the 4 character name)
 for l in open(filename, 'rU'):
     if 'XXX' in l:
-        num = 0
-        for i in l[4:]:
-            num += 1
-            if i == target:
-                print "incl", num*3-2, "-", num*3, ";"
-				
+        line = CharacterMatrix.from_rows([('XXX', l[4:].rstrip('\n'))])
+        for col in line.find_columns_with_residue(target):
+            print "incl", "%d - %d" % codon_range_for_column(col), ";"
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+import sys
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse import csgraph
+from dzutils import HitList, AhoCorasickMatcher, SetOfClusters, DagLine, DaglineIndex, blink_cluster_from_clique
+
+#graphs of hits (e.g. from blast or dagchainer) held as arrays of integer node ids with a table of
+#node names, rather than as sets of tuples of names
+
+
+class EdgeList(object):
+    '''Edges between named nodes, as two int32 arrays of node ids (sources and targets) indexing into the
+    names list, with optional float weights.
+    >>> edges = EdgeList.from_hits([('LOC_Os03g01008', 'OglabAA03S_FGT0268'), ('OglabAA03S_FGT0268', 'ObartAA03S_FGT0026'),
+    ...     ('LOC_Os03g01008', 'OglabAA03S_FGT0268')])
+    >>> len(edges), edges.names
+    (2, ['LOC_Os03g01008', 'ObartAA03S_FGT0026', 'OglabAA03S_FGT0268'])
+    >>> edges.write_dfmax(sys.stdout)
+    p EDGE 3 2
+    e 1 3
+    e 3 2
+    >>> edges.subgraph_by_names(['LOC'], which='source').write_abc(sys.stdout) # doctest: +NORMALIZE_WHITESPACE
+    LOC_Os03g01008	OglabAA03S_FGT0268
+    '''
+    def __init__(self, names, sources, targets, weights=None):
+        self.names = list(names)
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(self.sources) != len(self.targets) or (self.weights is not None and len(self.weights) != len(self.sources)):
+            raise ValueError('sources, targets and weights must be the same length')
+
+    @classmethod
+    def from_hits(cls, hits, weightField=None, evalueWeights=False):
+        '''Make an EdgeList from tuples of (query name, hit name, ...), such as the hitlist of a HitList.
+        If weightField is passed that field of each hit is used as its weight, converted with 
+        evalue_weights if evalueWeights.  Duplicate hits are only included once (the first of them), as 
+        in a HitList.  Node ids are given to the names in sorted order.'''
+        if isinstance(hits, HitList):
+            hits = hits.hitlist
+        queries, subjects, weights = [], [], []
+        seen = set()
+        for hit in hits:
+            if (hit[0], hit[1]) in seen:
+                continue
+            seen.add((hit[0], hit[1]))
+            queries.append(hit[0])
+            subjects.append(hit[1])
+            if weightField is not None:
+                weights.append(float(hit[weightField]))
+        #every name is interned (and numbered) by a single sort rather than dict lookups
+        names, ids = np.unique(np.array(queries + subjects, dtype=object), return_inverse=True)
+        if weightField is None:
+            weights = None
+        elif evalueWeights:
+            weights = evalue_weights(weights)
+        return cls(names.tolist(), ids[:len(queries)], ids[len(queries):], weights)
+
+    @classmethod
+    def from_dagline_index(cls, index):
+        '''Make an EdgeList from the hits in a DaglineIndex, using its (normalized) gene names and ids, 
+        weighted by their evalues (see evalue_weights)'''
+        sources, targets, evalues = [], [], []
+        for source, hits in enumerate(index.hits):
+            for target, line in hits.iteritems():
+                sources.append(source)
+                targets.append(target)
+                evalues.append(float(line.evalue if isinstance(line, DagLine) else line[8]))
+        return cls(index.gene_names, sources, targets, evalue_weights(evalues))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def num_nodes(self):
+        return len(self.names)
+
+    def node_mask_for_names(self, names, substring=True):
+        '''Boolean array over nodes of whether each node's name contains any of names (as HitList subsetting
+        does), or if substring is False, is one of names.'''
+        if substring:
+            matcher = AhoCorasickMatcher(names)
+            return np.array([ matcher.search(name) is not None for name in self.names ], dtype=bool)
+        names = set(names)
+        return np.array([ name in names for name in self.names ], dtype=bool)
+
+    def select(self, edgeMask):
+        '''new EdgeList with only the edges selected by a boolean mask or array of indices, sharing the names'''
+        return EdgeList(self.names, self.sources[edgeMask], self.targets[edgeMask],
+                None if self.weights is None else self.weights[edgeMask])
+
+    def subgraph_by_names(self, names, which='either', substring=True):
+        '''The edges whose source, target, either or both (which) are nodes with names matching names
+        (see node_mask_for_names), as HitList.get_sublist_by_query_names etc. select hits, other than that 
+        hits differing only after the query and hit names are already a single edge here (see from_hits).'''
+        nodeMask = self.node_mask_for_names(names, substring)
+        if which == 'source':
+            edgeMask = nodeMask[self.sources]
+        elif which == 'target':
+            edgeMask = nodeMask[self.targets]
+        elif which == 'either':
+            edgeMask = nodeMask[self.sources] | nodeMask[self.targets]
+        elif which == 'both':
+            edgeMask = nodeMask[self.sources] & nodeMask[self.targets]
+        else:
+            raise ValueError('unknown node selection %s' % which)
+        return self.select(edgeMask)
+
+    def compacted(self):
+        '''new EdgeList with only the nodes that are in some edge, renumbered consecutively'''
+        used, ids = np.unique(np.concatenate((self.sources, self.targets)), return_inverse=True)
+        return EdgeList([ self.names[node] for node in used ], ids[:len(self)], ids[len(self):], self.weights)
+
+    def write_dfmax(self, stream=sys.stdout):
+        '''write in DIMACS format for dfmax, with nodes numbered from 1.  Only nodes that are in some edge
+        are included.  Unlike HitList.output_for_dfmax, which numbers every field of the hits (so any further 
+        fields count as nodes in the header) in no particular order, only the sources and targets are numbered
+        here, in order of their names, and duplicate hits were already dropped (see from_hits) so each query 
+        and hit pair is a single edge.'''
+        graph = self.compacted()
+        stream.write('p EDGE %d %d\n' % (graph.num_nodes(), len(graph)))
+        if len(graph):
+            stream.write(''.join('e %d %d\n' % edge for edge in zip((graph.sources + 1).tolist(), (graph.targets + 1).tolist())))
+
+    def write_abc(self, stream=sys.stdout):
+        '''write in the label (abc) format read by mcl --abc, with weights if there are any'''
+        names = self.names
+        if self.weights is None:
+            stream.write(''.join('%s\t%s\n' % (names[source], names[target])
+                for source, target in zip(self.sources.tolist(), self.targets.tolist())))
+        else:
+            stream.write(''.join('%s\t%s\t%r\n' % (names[source], names[target], weight)
+                for source, target, weight in zip(self.sources.tolist(), self.targets.tolist(), self.weights.tolist())))
+
+    def adjacency(self, weighted=False):
+        '''symmetric CSR adjacency matrix over all nodes, ignoring edge direction and self hits.  If 
+        weighted the entries are the edge weights (1 if there aren't any), the largest of them where 
+        there are edges in both directions, otherwise they are all 1.'''
+        notSelf = self.sources != self.targets
+        rows = np.concatenate((self.sources[notSelf], self.targets[notSelf]))
+        cols = np.concatenate((self.targets[notSelf], self.sources[notSelf]))
+        numNodes = self.num_nodes()
+        if not weighted:
+            adjacency = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(numNodes, numNodes))
+            #duplicate edges were summed, but only whether there is one matters
+            adjacency.data[:] = 1
+            return adjacency
+        if self.weights is None:
+            weights = np.ones(len(rows))
+        else:
+            weights = np.concatenate((self.weights[notSelf], self.weights[notSelf]))
+        #sparse matrix construction would sum duplicates, so take the max of each run of them first
+        keys = rows.astype(np.int64) * numNodes + cols
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+        weights = np.maximum.reduceat(weights[order], starts) if len(keys) else weights
+        return sparse.csr_matrix((weights, (rows[order][starts], cols[order][starts])), shape=(numNodes, numNodes))
+
+
+def evalue_weights(evalues, cap=200.0):
+    '''edge weights from evalues, as -log10(evalue), capped at cap (which evalues of 0 also get).  This 
+    is the usual transformation of blast evalues for mcl (mcxload --stream-neg-log10 -stream-tf 'ceil(200)')
+    >>> evalue_weights([1e-50, 0.0, 1e-250]).tolist()
+    [50.0, 200.0, 200.0]
+    '''
+    evalues = np.asarray(evalues, dtype=np.float64)
+    weights = np.empty(len(evalues))
+    weights.fill(cap)
+    positive = evalues > 0.0
+    weights[positive] = np.minimum(-np.log10(evalues[positive]), cap)
+    return weights
+
+
+def connected_components(adjacency):
+    '''list of arrays of the nodes in each connected component (single linkage clusters, as BLINK finds)
+    of an adjacency matrix, in order of their lowest numbered node'''
+    numComponents, labels = csgraph.connected_components(adjacency, directed=False)
+    if not numComponents:
+        return []
+    order = np.argsort(labels, kind='mergesort')
+    return np.split(order, np.cumsum(np.bincount(labels, minlength=numComponents))[:-1])
+
+
+def degeneracy_ordering(neighbors):
+    '''nodes of a graph (dict of node to set of neighbors) in the order they are removed by repeatedly 
+    removing a node of least degree'''
+    degrees = dict( (node, len(nbrs)) for node, nbrs in neighbors.iteritems() )
+    buckets = [ set() for __ in xrange(max(degrees.itervalues()) + 1 if degrees else 0) ]
+    for node, degree in degrees.iteritems():
+        buckets[degree].add(node)
+    order = []
+    removed = set()
+    lowest = 0
+    for __ in xrange(len(degrees)):
+        while not buckets[lowest]:
+            lowest += 1
+        node = buckets[lowest].pop()
+        order.append(node)
+        removed.add(node)
+        for nbr in neighbors[node]:
+            if nbr not in removed:
+                degree = degrees[nbr]
+                buckets[degree].remove(nbr)
+                buckets[degree - 1].add(nbr)
+                degrees[nbr] = degree - 1
+        #removing a node can only lower the smallest degree by one
+        lowest = max(lowest - 1, 0)
+    return order
+
+
+def _bron_kerbosch_pivot(clique, candidates, excluded, neighbors):
+    if not candidates and not excluded:
+        yield clique
+        return
+    #branching only on nodes that aren't neighbors of the pivot avoids finding the same clique repeatedly
+    pivot = max(candidates | excluded, key=lambda node:len(candidates & neighbors[node]))
+    for node in list(candidates - neighbors[pivot]):
+        for found in _bron_kerbosch_pivot(clique + [node], candidates & neighbors[node], excluded & neighbors[node], neighbors):
+            yield found
+        candidates.remove(node)
+        excluded.add(node)
+
+
+def maximal_cliques(neighbors):
+    '''Generator of all maximal cliques (as lists of nodes) of a graph given as a dict of node to set of 
+    neighbors, by Bron-Kerbosch with pivoting, with the outer level in degeneracy order
+    >>> sorted(sorted(clique) for clique in maximal_cliques({1:set([2, 3]), 2:set([1, 3]), 3:set([1, 2, 4]), 4:set([3]), 5:set()}))
+    [[1, 2, 3], [3, 4], [5]]
+    '''
+    order = degeneracy_ordering(neighbors)
+    position = dict( (node, num) for num, node in enumerate(order) )
+    for node in order:
+        later = set(nbr for nbr in neighbors[node] if position[nbr] > position[node])
+        earlier = set(nbr for nbr in neighbors[node] if position[nbr] < position[node])
+        for clique in _bron_kerbosch_pivot([node], later, earlier, neighbors):
+            yield clique
+
+
+def _component_cliques(job):
+    '''the maximal cliques of one component (each sorted, and in sorted order so that the output doesn't 
+    depend on the search order), or only the largest if maximumOnly, possibly in a worker process.  Takes 
+    a single tuple so it can be used with Pool.imap'''
+    neighbors, maximumOnly = job
+    cliques = sorted(sorted(clique) for clique in maximal_cliques(neighbors))
+    if maximumOnly:
+        return [ max(cliques, key=len) ]
+    return cliques
+
+
+def find_clusters(edges, method='components', numProcesses=None):
+    '''Cluster the nodes of an EdgeList (or HitList), returning a SetOfClusters with BlinkClusters numbered 
+    from 0.  method is one of
+    components - connected components (single linkage, like BLINK)
+    cliques    - all maximal cliques within each component (so a node can be in several)
+    maximum    - a largest clique in each component, with the remaining nodes of the component left out
+    Clique finding is done for each component of more than two nodes in a pool of numProcesses worker 
+    processes if numProcesses is more than 1.
+    >>> edges = EdgeList.from_hits([('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd'), ('e', 'f')])
+    >>> [ clust.cluster_members for clust in find_clusters(edges).blink_clusters ]
+    [['a', 'b', 'c', 'd'], ['e', 'f']]
+    >>> [ clust.cluster_members for clust in find_clusters(edges, 'cliques').blink_clusters ]
+    [['a', 'b', 'c'], ['c', 'd'], ['e', 'f']]
+    '''
+    if not isinstance(edges, EdgeList):
+        edges = EdgeList.from_hits(edges)
+    edges = edges.compacted()
+    adjacency = edges.adjacency()
+    components = connected_components(adjacency)
+    if method == 'components':
+        return SetOfClusters([ blink_cluster_from_clique(num, comp, mapping=edges.names) for num, comp in enumerate(components) ])
+    elif method not in ('cliques', 'maximum'):
+        raise ValueError('unknown clustering method %s' % method)
+
+    indptr, indices = adjacency.indptr, adjacency.indices
+    def component_job(comp):
+        nodes = comp.tolist()
+        return dict( (node, set(indices[indptr[node]:indptr[node + 1]].tolist())) for node in nodes ), method == 'maximum'
+
+    #components of one or two nodes are their own only clique, and not worth sending to a worker
+    large = [ comp for comp in components if len(comp) > 2 ]
+    pool = None
+    if numProcesses is not None and numProcesses > 1 and large:
+        pool = multiprocessing.Pool(min(numProcesses, len(large)))
+        results = pool.imap(_component_cliques, (component_job(comp) for comp in large), chunksize=16)
+    else:
+        results = itertools.imap(_component_cliques, (component_job(comp) for comp in large))
+
+    clusters = []
+    try:
+        for comp in components:
+            cliques = next(results) if len(comp) > 2 else [ comp.tolist() ]
+            for clique in cliques:
+                clusters.append(blink_cluster_from_clique(len(clusters), clique, mapping=edges.names))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return SetOfClusters(clusters)
+
+
+#Markov clustering (as the mcl program does), on row stochastic CSR matrices.  This is the transpose of
+#the column stochastic matrix mcl describes, which is the same thing but with the per column operations
+#(inflation, pruning) becoming per row ones that work directly on contiguous stretches of the CSR arrays
+
+def _row_ids(matrix):
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+
+def _normalize_rows(matrix):
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    sums[sums == 0.0] = 1.0
+    matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+    return matrix
+
+
+def _prune_rows(matrix, threshold, topK):
+    '''Drop entries below threshold and all but the largest topK in each row, except that the largest in 
+    each row is always kept.  Doesn't renormalize.'''
+    rowIds = _row_ids(matrix)
+    #order entries by row and by decreasing value within rows, so that the rank of each in its row is its
+    #offset from the start of the row
+    order = np.lexsort((-matrix.data, rowIds))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - matrix.indptr[rowIds[order]]
+    keep = (matrix.data >= threshold) | (rank == 0)
+    if topK is not None:
+        keep &= rank < topK
+    if keep.all():
+        return matrix
+    pruned = sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], np.concatenate(([0], np.cumsum(np.bincount(rowIds[keep], minlength=matrix.shape[0]))))), 
+            shape=matrix.shape)
+    return pruned
+
+
+def _multiply_and_prune(left, right, threshold, topK, pool=None, blockRows=1024):
+    '''left * right pruned as by _prune_rows, made in blocks of blockRows rows of left that are each 
+    pruned as soon as they are multiplied, so that only the blocks being worked on are ever held unpruned
+    (as mcl prunes each column as it is computed), rather than the whole product.  The blocks are spread 
+    over a pool of threads if one is passed (the sparse products are done by scipy without the GIL, so 
+    the threads really do run at once).'''
+    numRows = left.shape[0]
+    bounds = range(0, numRows, blockRows) + [numRows]
+    blockRanges = zip(bounds[:-1], bounds[1:])
+    if not blockRanges:
+        return (left * right).tocsr()
+    def block_product((start, end)):
+        return _prune_rows((left[start:end] * right).tocsr(), threshold, topK)
+    if pool is not None:
+        blocks = pool.imap(block_product, blockRanges)
+    else:
+        blocks = itertools.imap(block_product, blockRanges)
+    return sparse.vstack(list(blocks), format='csr')
+
+
+def _attractor_clusters(matrix, threshold=1e-8):
+    '''Interpret a converged MCL matrix as mcl does, returning an array of the cluster of each node.  
+    Attractors are the nodes with a value on the diagonal of at least threshold, and attractors with 
+    flow between them are in the same cluster.  Every other node goes in the cluster that it has the 
+    most flow to (so values that are nearly zero but weren't pruned can't join clusters together), or 
+    a cluster of its own if it has no flow to any attractor (which can only happen before convergence).'''
+    numNodes = matrix.shape[0]
+    attractors = np.flatnonzero(matrix.diagonal() >= threshold)
+    flows = matrix[:, attractors].tocsr()
+    flows.data[flows.data < threshold] = 0.0
+    flows.eliminate_zeros()
+    __, attractorLabels = csgraph.connected_components(flows[attractors], directed=False)
+    #total flow from each node to each cluster of attractors
+    flowCoo = flows.tocoo()
+    clusterFlows = sparse.csr_matrix((flowCoo.data, (flowCoo.row, attractorLabels[flowCoo.col])), 
+            shape=(numNodes, attractorLabels.max() + 1 if len(attractors) else 1))
+    labels = np.asarray(clusterFlows.argmax(axis=1)).ravel()
+    labels[attractors] = attractorLabels
+    orphans = np.flatnonzero(np.diff(clusterFlows.indptr) == 0)
+    if len(orphans):
+        labels[orphans] = labels.max() + 1 + np.arange(len(orphans))
+    return labels
+
+
+def _group_by_label(labels):
+    '''list of arrays of the nodes with each label, in order of their lowest numbered node'''
+    if not len(labels):
+        return []
+    order = np.argsort(labels, kind='mergesort')
+    groups = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    groups.sort(key=lambda group:group[0])
+    return groups
+
+
+def markov_matrix(graph, loopWeight=None):
+    '''Row stochastic CSR matrix for MCL from an EdgeList (weighted if it has weights) and the compacted
+    EdgeList whose nodes it is over.  Self hits are replaced by loops on every node, weighted by loopWeight, 
+    or by default as mcl does by the largest weight of the node's other edges.'''
+    graph = graph.compacted()
+    adjacency = graph.adjacency(weighted=True).astype(np.float64)
+    if loopWeight is None:
+        loops = np.zeros(adjacency.shape[0])
+        nonEmpty = np.diff(adjacency.indptr) > 0
+        loops[nonEmpty] = np.maximum.reduceat(adjacency.data, adjacency.indptr[:-1][nonEmpty])
+        #nodes only hitting themselves
+        loops[loops == 0.0] = 1.0
+    else:
+        loops = np.empty(adjacency.shape[0])
+        loops.fill(loopWeight)
+    matrix = (adjacency + sparse.diags(loops, 0, format='csr')).tocsr()
+    return _normalize_rows(matrix), graph
+
+
+def markov_clusters(graph, inflation=2.0, expansion=2, pruneThreshold=1e-4, topK=1100, maxIterations=100, 
+        tolerance=1e-6, loopWeight=None, numThreads=None):
+    '''Cluster a graph by Markov clustering, returning a SetOfClusters of BlinkClusters numbered from 1 in 
+    order of decreasing size, as parse_mcl_output does.  graph is an EdgeList (weighted if it has weights), 
+    HitList (unweighted) or DaglineIndex (weighted by evalue).
+    Each iteration raises the matrix to the power expansion, pruning small values (below pruneThreshold, and 
+    beyond the largest topK, which is what mcl -P and -S do) from each block of rows of the product as it
+    is made, so that memory use is bounded by the size of the pruned matrix, and then inflates (raises each value to the 
+    power inflation and renormalizes).  This continues until no value changes by more than tolerance, or 
+    for maxIterations.  Clusters are the attractors and the nodes flowing to them (see _attractor_clusters).  
+    Sparse products are split over numThreads threads if it is more than 1.
+    >>> edges = EdgeList.from_hits([('a', 'b'), ('b', 'c'), ('a', 'c'), ('c', 'd'), ('d', 'e'), ('e', 'f'), ('d', 'f'), ('g', 'g')])
+    >>> [ (clust.number, clust.cluster_members) for clust in markov_clusters(edges).blink_clusters ]
+    [(1, ['a', 'b', 'c']), (2, ['d', 'e', 'f']), (3, ['g'])]
+    >>> [ clust.cluster_members for clust in markov_clusters(edges, pruneThreshold=0).blink_clusters ]
+    [['a', 'b', 'c'], ['d', 'e', 'f'], ['g']]
+    '''
+    if isinstance(graph, DaglineIndex):
+        graph = EdgeList.from_dagline_index(graph)
+    elif not isinstance(graph, EdgeList):
+        graph = EdgeList.from_hits(graph)
+    matrix, graph = markov_matrix(graph, loopWeight)
+
+    pool = ThreadPool(numThreads) if numThreads is not None and numThreads > 1 else None
+    try:
+        for iteration in xrange(maxIterations):
+            expanded = matrix
+            for __ in xrange(expansion - 1):
+                expanded = _multiply_and_prune(expanded, matrix, pruneThreshold, topK, pool)
+            expanded.data **= inflation
+            expanded = _normalize_rows(expanded)
+            change = abs(expanded - matrix)
+            matrix = expanded
+            if change.nnz == 0 or change.data.max() <= tolerance:
+                break
+        else:
+            sys.stderr.write('MCL did not converge in %d iterations\n' % maxIterations)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    clusters = _group_by_label(_attractor_clusters(matrix))
+    #largest first, as mcl outputs them, otherwise in order of their lowest numbered node
+    clusters.sort(key=lambda clust:-len(clust))
+    return SetOfClusters([ blink_cluster_from_clique(num, clust.tolist(), mapping=graph.names) for num, clust in enumerate(clusters, 1) ])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
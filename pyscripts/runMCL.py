@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import sys
+import time
+from argparse import ArgumentParser
+from dzutils import parse_hits_file, parse_mcl_output, iterate_daglines, DaglineIndex, SetOfClusters
+from clusterutils import ClusteringComparison
+from graphutils import EdgeList, markov_clusters
+
+#use argparse module to parse commandline input
+parser = ArgumentParser(description='Markov clustering (as the mcl program does) of a file of hits, with output in the same \
+        format as mcl.  Multiple inflation values can be given to try each of them on the same graph, and the results can be \
+        compared to the output of an mcl run.')
+
+parser.add_argument('hitFile', type=str,
+                    help='file of hits, one per line, with whitespace separated query and hit names as the first two fields')
+
+parser.add_argument('-d', '--daglines', action='store_true', default=False,
+                    help='the hit file is dagchainer output, with hits weighted by their evalues')
+
+parser.add_argument('-e', '--evalue-field', dest='evalueField', type=int, default=None,
+                    help='weight hits by the evalue in this field (counting from 0, so 10 for tabular blast output) of the hit file \
+                    (default no weights)')
+
+parser.add_argument('-I', '--inflation', nargs='+', type=float, default=[2.0],
+                    help='inflation value(s) (default 2.0)')
+
+parser.add_argument('-P', '--prune-threshold', dest='pruneThreshold', type=float, default=1e-4,
+                    help='drop values below this after expansion (default 1e-4, which is mcl -P 10000)')
+
+parser.add_argument('-S', '--top-k', dest='topK', type=int, default=1100,
+                    help='keep only this many of the largest values for each node after expansion (default 1100, as mcl -S)')
+
+parser.add_argument('--max-iterations', dest='maxIterations', type=int, default=100,
+                    help='maximum number of iterations (default 100)')
+
+parser.add_argument('-t', '--threads', type=int, default=None,
+                    help='number of threads to split sparse matrix products over')
+
+parser.add_argument('-o', '--output-prefix', dest='outPrefix', type=str, default=None,
+                    help='write clusters to files named <prefix>.I<inflation * 10>, as mcl names them (default stdout, for a single inflation)')
+
+parser.add_argument('-c', '--compare', type=str, default=None,
+                    help='mcl output file to compare the clusters for each inflation to')
+
+#now process the command line
+options = parser.parse_args()
+
+if len(options.inflation) > 1 and options.outPrefix is None:
+    sys.exit('an output prefix (-o) is needed for multiple inflation values')
+
+start = time.time()
+if options.daglines:
+    graph = EdgeList.from_dagline_index(DaglineIndex(iterate_daglines(options.hitFile)))
+else:
+    graph = EdgeList.from_hits(parse_hits_file(options.hitFile), options.evalueField, evalueWeights=True)
+sys.stderr.write('read %d hits among %d genes in %.2f seconds\n' % (len(graph), graph.num_nodes(), time.time() - start))
+
+mclClusters = SetOfClusters(parse_mcl_output(options.compare)) if options.compare else None
+
+for inflation in options.inflation:
+    start = time.time()
+    clusters = markov_clusters(graph, inflation=inflation, pruneThreshold=options.pruneThreshold, topK=options.topK,
+            maxIterations=options.maxIterations, numThreads=options.threads)
+    sys.stderr.write('inflation %g: %d clusters in %.2f seconds\n' % (inflation, len(clusters.blink_clusters), time.time() - start))
+
+    if options.outPrefix is not None:
+        outFile = open('%s.I%d' % (options.outPrefix, int(round(inflation * 10))), 'w')
+    else:
+        outFile = sys.stdout
+    for clust in clusters.blink_clusters:
+        outFile.write('\t'.join(clust.cluster_members) + '\n')
+    if outFile is not sys.stdout:
+        outFile.close()
+
+    if mclClusters is not None:
+        comparison = ClusteringComparison(clusters, mclClusters)
+        sys.stderr.write('\tcompared to %s: adjusted Rand index %.4f, variation of information %.4f\n' % (options.compare,
+            comparison.adjusted_rand_index(), comparison.variation_of_information()))
+        sys.stderr.write('\t%s\n' % ', '.join('%s %d' % item for item in sorted(comparison.summary().items())))